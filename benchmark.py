@@ -0,0 +1,341 @@
+"""Benchmarks for hesperus' message path.
+
+    python benchmark.py load config.xml [--messages N] [--rate R]
+                                        [--mix direct=1,chatter=8,multi=1]
+                                        [--channels default,...]
+                                        [--command MSG ...] [--chatter MSG ...]
+    python benchmark.py dispatch [--messages N] [--channels N]
+                                 [--handler-ms MS] [--workers 0,1,2,4,8]
+
+load builds a core from a config file, the same way gitbot.py does, and
+feeds it messages from an in-process FakeConnector instead of IRC. The mix
+says how often to send each kind of message:
+
+    direct      a command from --command, addressed to the bot
+    chatter     a line from --chatter, not addressed to the bot
+    multi       chatter that arrives on two channels at once
+
+With --rate, messages are sent on a fixed schedule of R per second no matter
+how far behind the bot falls, and latency counts from when each message was
+due, so a stalled bot can't hide its backlog. Without it they are all sent
+at once. It reports throughput until the bot has finished with every
+message, reply latency percentiles and how much handler time each plugin
+used. A message is finished once no agent has a call for it queued or
+running and the command tasks AsyncPlugins started for it are done.
+
+Plugins handle messages on their own threads in the calls column, and on
+the core's dispatch thread or a dispatch lane in the inline column, as
+commands_queued = False plugins do. Inline time is also part of the Core
+and DispatchLane rows' handler time, since that's where it was spent.
+
+dispatch measures how incoming message throughput scales with the core's
+dispatch-workers setting. Each message goes to a plugin whose handler
+blocks for --handler-ms on the dispatch thread, standing in for plugins that
+do I/O without queueing it. It also checks that messages from each channel
+were handled in the order they were sent.
+
+Handlers that burn CPU instead of blocking won't scale: the dispatch lanes
+are threads, and only one of them runs python code at a time.
+
+"""
+import argparse
+import random
+import threading
+import time
+import sys
+
+from hesperus.agent import Agent
+from hesperus.core import Core
+from hesperus.plugin import Plugin, CommandPlugin, AsyncPlugin
+
+class FakeConnector(Plugin):
+    """Stands in for a connector such as the IRC plugin. Replies and outgoing
+    messages are only counted."""
+    def __init__(self, core):
+        super(FakeConnector, self).__init__(core)
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.unanswered = 0
+        self.outgoing = 0
+
+    def send(self, chans, msg, direct, due):
+        answered = [False]
+        def reply(text):
+            now = time.time()
+            with self.lock:
+                if not answered[0]:
+                    answered[0] = True
+                    self.latencies.append(now - due)
+        self.parent.handle_incoming(chans, 'bench', msg, direct, reply)
+
+    def send_outgoing(self, chan, msg):
+        with self.lock:
+            self.outgoing += 1
+
+class BlockingPlugin(CommandPlugin):
+    commands_queued = False
+
+    def __init__(self, core, handler_ms):
+        super(BlockingPlugin, self).__init__(core)
+        self.handler_time = handler_ms / 1000.0
+        self.lock = threading.Lock()
+        self.seen = {}
+
+    @CommandPlugin.register_command(r"work (\d+)", direct_only=False)
+    def work(self, chans, name, match, direct, reply):
+        time.sleep(self.handler_time)
+        with self.lock:
+            self.seen.setdefault(chans[0], []).append(int(match.group(1)))
+        reply(match.group(1))
+
+def quiet_logging():
+    """Only let warnings and errors through to the console"""
+    log = Agent.log
+    def quiet_log(self, level, *message):
+        if level >= 3:
+            log(self, level, *message)
+    Agent.log = quiet_log
+
+def start_core(core):
+    thread = threading.Thread(target=core.start)
+    thread.daemon = True
+    thread.start()
+    while not core.running:
+        time.sleep(0.01)
+    return thread
+
+class InFlight(object):
+    """Counts the work the bot hasn't finished yet: calls waiting in or
+    running on any agent's queue, calls on their way to an AsyncPlugin's
+    loop and the tasks those calls spawned.
+
+    It also times each plugin's handle_incoming, which runs on the thread
+    that dispatched the message, into the plugin's inline stat.
+
+    """
+    def __init__(self, core):
+        self.core = core
+        self.lock = threading.Lock()
+        self.async_calls = 0
+        self.tasks = set()
+        for plug in core.plugins:
+            if isinstance(plug, AsyncPlugin):
+                self.track_async(plug)
+            elif not isinstance(plug, FakeConnector):
+                self.time_inline(plug)
+
+    def time_inline(self, plug):
+        handle_incoming = plug.handle_incoming
+        def timed(*args):
+            started = time.time()
+            try:
+                handle_incoming(*args)
+            finally:
+                plug.stats.record('inline', time.time() - started)
+        plug.handle_incoming = timed
+
+    def track_async(self, plug):
+        handle_incoming = plug.handle_incoming
+        incoming = plug._incoming
+        spawn = plug.spawn
+        # only the loop thread spawns, and only tasks spawned from
+        # _incoming are for a message
+        handling = [False]
+        def tracked_handle_incoming(*args):
+            if plug.loop is not None:
+                with self.lock:
+                    self.async_calls += 1
+            handle_incoming(*args)
+        def tracked_incoming(*args):
+            handling[0] = True
+            try:
+                incoming(*args)
+            finally:
+                handling[0] = False
+                with self.lock:
+                    self.async_calls -= 1
+        def tracked_spawn(*args, **kwargs):
+            task = spawn(*args, **kwargs)
+            if handling[0]:
+                with self.lock:
+                    self.tasks.add(task)
+            return task
+        plug.handle_incoming = tracked_handle_incoming
+        plug._incoming = tracked_incoming
+        plug.spawn = tracked_spawn
+
+    def pending(self):
+        count = 0
+        for agent in [self.core] + self.core.lanes + list(self.core.plugins):
+            stats = agent.stats
+            # enqueue_delay is recorded as a call starts and handler as it
+            # ends, so the difference is how many are running
+            count += agent.queue.qsize() + stats.enqueue_delay.count - stats.handler.count
+        with self.lock:
+            self.tasks = set(task for task in self.tasks if not task.done())
+            return count + self.async_calls + len(self.tasks)
+
+def wait_idle(inflight, timeout):
+    """Waits until nothing is in flight, a few polls in a row"""
+    deadline = time.time() + timeout
+    quiet = 0
+    while quiet < 3 and time.time() < deadline:
+        if inflight.pending() == 0:
+            quiet += 1
+        else:
+            quiet = 0
+        time.sleep(0.01)
+    return quiet >= 3
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        kind, _, weight = part.partition('=')
+        if not kind in ('direct', 'chatter', 'multi'):
+            raise ValueError('unknown message kind "%s"' % (kind,))
+        weights[kind] = int(weight or 1)
+    return weights
+
+def run_load(args):
+    core = Core.load_from_file(args.config)
+    connector = FakeConnector(core)
+    for chan in args.channels.split(','):
+        connector.subscribe(chan)
+    core.add_plugin(connector)
+    chans = connector.channels
+
+    weights = parse_mix(args.mix)
+    kinds = [kind for kind in sorted(weights) for _ in range(weights[kind])]
+    commands = args.command or ['help']
+    chatter = args.chatter or ['so anyway, that build is still broken',
+            'check out http://example.com/some/page', 'it is 20C outside']
+    rand = random.Random(args.seed)
+
+    inflight = InFlight(core)
+    thread = start_core(core)
+    started = time.time()
+    for i in range(args.messages):
+        if args.rate:
+            due = started + i / args.rate
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            due = time.time()
+        kind = rand.choice(kinds)
+        if kind == 'direct':
+            connector.send([rand.choice(chans)], rand.choice(commands), True, due)
+        elif kind == 'chatter':
+            connector.send([rand.choice(chans)], rand.choice(chatter), False, due)
+        else:
+            connector.send(rand.sample(chans, min(2, len(chans))), rand.choice(chatter), False, due)
+    sent = time.time() - started
+    drained = wait_idle(inflight, args.timeout)
+    elapsed = time.time() - started
+    stats = core.collect_stats()
+    core.stop()
+    thread.join(5)
+
+    latencies = sorted(connector.latencies)
+    print "sent %d messages in %.2fs, drained after %.2fs%s" % (
+            args.messages, sent, elapsed, '' if drained else ' (TIMED OUT)')
+    print "throughput %.0f msg/s, %d replies, %d outgoing" % (
+            args.messages / elapsed, len(latencies), connector.outgoing)
+    print "reply latency p50 %.2fms  p99 %.2fms  p999 %.2fms  max %.2fms" % tuple(
+            1000 * v for v in (percentile(latencies, 50), percentile(latencies, 99),
+                percentile(latencies, 99.9), latencies[-1] if latencies else 0.0))
+    print
+    print "%-24s %8s %10s %10s %10s %10s %8s" % (
+            'agent', 'calls', 'total', 'mean', 'p99', 'inline', 'dropped')
+    for name, summary in stats:
+        h = summary['handler']
+        inline = summary.get('inline')
+        inline = 1000 * inline['mean'] * inline['count'] if inline else 0.0
+        print "%-24s %8d %9.1fms %9.3fms %9.3fms %9.1fms %8d" % (
+                name, h['count'], 1000 * h['mean'] * h['count'], 1000 * h['mean'],
+                1000 * h['p99'], inline, summary['dropped'])
+
+def run_dispatch(workers, messages, channels, handler_ms):
+    core = Core(dispatch_workers=workers)
+    plug = BlockingPlugin(core, handler_ms)
+    chans = ['bench%d' % (i,) for i in range(channels)]
+    for chan in chans:
+        plug.subscribe(chan)
+    core.add_plugin(plug)
+
+    done = threading.Event()
+    remaining = [messages]
+    remaining_lock = threading.Lock()
+    def reply(msg):
+        with remaining_lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                done.set()
+
+    thread = start_core(core)
+    started = time.time()
+    for i in range(messages):
+        core.handle_incoming([chans[i % channels]], 'bench', 'work %d' % (i,), False, reply)
+    done.wait()
+    elapsed = time.time() - started
+
+    core.stop()
+    thread.join()
+
+    in_order = all(seq == sorted(seq) for seq in plug.seen.values())
+    return messages / elapsed, in_order
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks for hesperus' message path")
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    load = subparsers.add_parser('load', help='load test a configured bot')
+    load.add_argument('config')
+    load.add_argument('--messages', type=int, default=5000)
+    load.add_argument('--rate', type=float, default=0,
+            help='messages per second, default is as fast as possible')
+    load.add_argument('--mix', default='direct=1,chatter=8,multi=1')
+    load.add_argument('--channels', default='default',
+            help='comma separated channels the fake connector sends on')
+    load.add_argument('--command', action='append',
+            help='a direct message to send, may be repeated')
+    load.add_argument('--chatter', action='append',
+            help='an undirected message to send, may be repeated')
+    load.add_argument('--seed', type=int, default=0)
+    load.add_argument('--timeout', type=float, default=60.0,
+            help='how long to wait for the queues to drain')
+
+    dispatch = subparsers.add_parser('dispatch', help='compare dispatch-workers settings')
+    dispatch.add_argument('--messages', type=int, default=2000)
+    dispatch.add_argument('--channels', type=int, default=16)
+    dispatch.add_argument('--handler-ms', type=float, default=1.0)
+    dispatch.add_argument('--workers', default='0,1,2,4,8',
+            help='comma separated dispatch-workers settings to compare')
+    args = parser.parse_args(argv)
+
+    quiet_logging()
+
+    if args.benchmark == 'load':
+        run_load(args)
+    else:
+        run_dispatch_comparison(args)
+
+def run_dispatch_comparison(args):
+    print "%d messages over %d channels, handlers block for %.1fms" % (
+            args.messages, args.channels, args.handler_ms)
+    baseline = None
+    for workers in [int(w) for w in args.workers.split(',')]:
+        rate, in_order = run_dispatch(workers, args.messages, args.channels, args.handler_ms)
+        if baseline is None:
+            baseline = rate
+        print "dispatch-workers=%-3d %8.0f msg/s  %5.2fx  %s" % (
+                workers, rate, rate / baseline,
+                'in order' if in_order else 'OUT OF ORDER')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,10 +1,142 @@
 import threading
 import time
-from Queue import Queue, Empty
+import os
+import errno
+import fcntl
+import select
+from Queue import Empty
+from collections import deque
 from traceback import format_exc
 from ansi import colored
+from stats import AgentStats
 import sys
 
+class Waker(object):
+    """A self-pipe that lets other threads interrupt an agent that is
+    sleeping in select(). Writing a byte makes the read end readable, so the
+    sleeping thread wakes up immediately instead of at its next poll.
+
+    """
+    def __init__(self):
+        self._r, self._w = os.pipe()
+        for fd in (self._r, self._w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+    def fileno(self):
+        return self._r
+
+    def wake(self):
+        try:
+            os.write(self._w, 'x')
+        except OSError, e:
+            # a full pipe already guarantees a wakeup
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def drain(self):
+        try:
+            while os.read(self._r, 4096):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def close(self):
+        for fd in (self._r, self._w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def __del__(self):
+        self.close()
+
+class AgentQueue(object):
+    """The queue of calls waiting to run in an agent. What happens when it is
+    full depends on the policy:
+
+    block           the caller waits for room (the default)
+    drop-newest     the new call is discarded
+    drop-oldest     the oldest waiting call is discarded to make room
+
+    Calls put with a key replace a call with the same key that is still
+    waiting, instead of being queued a second time. Dropped and coalesced
+    calls are counted in the agent's stats. Items are tuples whose last
+    element is the time they were queued.
+
+    """
+    POLICIES = ('block', 'drop-newest', 'drop-oldest')
+
+    def __init__(self, maxsize, policy, stats):
+        self._cond = threading.Condition(threading.Lock())
+        self._items = deque()
+        self._keys = {}
+        self.stats = stats
+        self.configure(maxsize, policy)
+
+    def configure(self, maxsize=None, policy=None):
+        if policy is not None and not policy in self.POLICIES:
+            raise ValueError('queue policy must be one of %s' % (', '.join(self.POLICIES),))
+        if maxsize is not None and maxsize < 1:
+            raise ValueError('queue size must be at least 1')
+        with self._cond:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if policy is not None:
+                self.policy = policy
+            self._cond.notify_all()
+
+    def put(self, item, key=None):
+        with self._cond:
+            if key is not None:
+                entry = self._keys.get(key)
+                if entry is not None:
+                    # keep the waiting call's queued time, the last item, so
+                    # enqueue_delay counts from the first of the coalesced calls
+                    entry[0] = item[:-1] + entry[0][-1:]
+                    self.stats.count('coalesced')
+                    return
+            if len(self._items) >= self.maxsize:
+                if self.policy == 'drop-newest':
+                    self.stats.count('dropped')
+                    return
+                elif self.policy == 'drop-oldest':
+                    self._forget(self._items.popleft())
+                    self.stats.count('dropped')
+                else:
+                    started = time.time()
+                    while len(self._items) >= self.maxsize:
+                        self._cond.wait()
+                    self.stats.record('blocked_put', time.time() - started)
+            entry = [item, key]
+            self._items.append(entry)
+            if key is not None:
+                self._keys[key] = entry
+            depth = len(self._items)
+        self.stats.queue_depth(depth)
+
+    def get_nowait(self):
+        with self._cond:
+            if not self._items:
+                raise Empty
+            entry = self._items.popleft()
+            self._forget(entry)
+            self._cond.notify()
+        return entry[0]
+
+    def _forget(self, entry):
+        if entry[1] is not None:
+            del self._keys[entry[1]]
+
+    def empty(self):
+        return not self._items
+
+    def qsize(self):
+        return len(self._items)
+
 class Agent(object):
     """An agent is a class whose instances follow a standard protocol for
     running and for communicating with other agents.
@@ -40,9 +172,39 @@ class Agent(object):
     If the agent is to become the master of the current thread, the caller can
     just call start(), which does not return.
 
+    Finally, the agent may share threads with other agents by calling
+    start_pooled() with a runtime.WorkerPool. The pool runs the agent's run()
+    steps and queued calls on whichever worker thread is free, but never on
+    two threads at once, so the agent sees the same ordering as it would in a
+    thread of its own.
+
+    Calls wait in an AgentQueue of queue_size entries, and queue_policy says
+    what happens when it fills up. Methods decorated with @Agent.coalesced
+    replace an identical call that is still waiting instead of queueing
+    another one.
+
+    Every agent keeps an AgentStats in self.stats with how long queued calls
+    wait and run, how long run() steps take and how full the queue gets.
+
+    Between run() steps the agent sleeps until either a queued call arrives or
+    the step's deadline passes, whichever comes first. run() picks the deadline
+    with the value it yields: a number of seconds to sleep at most, or None
+    (a bare yield) for the default of idle_wait seconds. Yielding 0 asks to be
+    run again right away, and yielding Agent.FOREVER sleeps until woken.
+    Agents that wait on sockets can list them in wait_fds() to also be woken
+    when one of them becomes readable.
+
     """
 
     stdout_lock = threading.RLock()
+
+    # how long a bare yield in run() sleeps when nothing wakes us earlier
+    idle_wait = 0.1
+    # yield this from run() to sleep until a queued call wakes us
+    FOREVER = float('inf')
+    # see AgentQueue
+    queue_size = 1000
+    queue_policy = 'block'
     
     def __init__(self, daemon=False):
         self.lock = threading.RLock()
@@ -50,7 +212,13 @@ class Agent(object):
         self._error = None
         self._thread = None
         self._daemon = daemon
-        self.queue = Queue(1000)
+        self.stats = AgentStats()
+        self.queue = AgentQueue(self.queue_size, self.queue_policy, self.stats)
+        self._waker = Waker()
+        # set while running on a WorkerPool
+        self._pool = None
+        self._steps = None
+        self._step_thread = None
     
     # decorator to force a function to execute in the Agent's thread
     # XXX If the agent is not running in its own thread, will @queued methods
@@ -60,12 +228,33 @@ class Agent(object):
     @classmethod
     def queued(cls, func):
         def queued_intern(self, *args, **kwargs):
-            with self.lock:
-                if threading.current_thread() == self.thread:
-                    func(self, *args, **kwargs)
-                    return
-            self.queue.put((func, args, kwargs), True)
+            self._enqueue(func, args, kwargs, None)
         return queued_intern
+
+    # like queued, but while a call is still waiting in the queue, another
+    # call with the same key replaces it instead of being queued as well. The
+    # key is computed from the call's arguments by key(self, *args,
+    # **kwargs), and defaults to the arguments themselves.
+    @classmethod
+    def coalesced(cls, key=None):
+        def sub_generator(func):
+            def coalesced_intern(self, *args, **kwargs):
+                if key is None:
+                    k = (args, tuple(sorted(kwargs.items())))
+                else:
+                    k = key(self, *args, **kwargs)
+                self._enqueue(func, args, kwargs, (func, k))
+            return coalesced_intern
+        return sub_generator
+
+    def _enqueue(self, func, args, kwargs, key):
+        with self.lock:
+            current = threading.current_thread()
+            if current == self.thread or current == self._step_thread:
+                func(self, *args, **kwargs)
+                return
+        self.queue.put((func, args, kwargs, time.time()), key)
+        self.wake()
     
     @property
     def running(self):
@@ -81,11 +270,62 @@ class Agent(object):
     def thread(self):
         with self.lock:
             return self._thread
+
+    @property
+    def active(self):
+        """True until the agent's run loop has completely finished, whether
+        it runs in its own thread or on a worker pool"""
+        with self.lock:
+            return self._thread is not None or self._pool is not None
     
     # override this in a subclass and yield every once in a while
     def run(self):
         while True:
-            yield
+            yield self.FOREVER
+
+    def wake(self):
+        """Interrupt the agent's sleep between run() steps, if any"""
+        pool = self._pool
+        if pool is not None:
+            pool.submit(self)
+        else:
+            self._waker.wake()
+
+    # override this in a subclass to be told when run() or a queued call
+    # raised; self.error is already set when this is called
+    def crashed(self):
+        pass
+
+    # override this in a subclass to return files or sockets that should end
+    # the sleep between run() steps when they become readable. Only used when
+    # running in a thread of our own.
+    def wait_fds(self):
+        return ()
+
+    def _sleep(self, timeout):
+        """Sleep for at most timeout seconds, or until wake() is called or one
+        of wait_fds() is readable"""
+        if timeout == self.FOREVER:
+            timeout = None
+        try:
+            select.select([self._waker] + list(self.wait_fds()), [], [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+        self._waker.drain()
+
+    def _drain_queue(self):
+        while self._running:
+            try:
+                item = self.queue.get_nowait()
+            except Empty:
+                break
+            else:
+                func, args, kwargs, queued_at = item
+                started = time.time()
+                self.stats.record('enqueue_delay', started - queued_at)
+                func(self, *args, **kwargs)
+                self.stats.record('handler', time.time() - started)
         
     def start(self):
         with self.lock:
@@ -101,26 +341,27 @@ class Agent(object):
             # single bytecode operation. It's especially safe here since
             # _running will always be one of the boolean singletons.
             while self._running:
+                started = time.time()
                 try:
-                    it.next()
+                    delay = it.next()
                 except StopIteration:
                     break
+                self.stats.record('step', time.time() - started)
                 
-                # give a little leeway
-                time.sleep(0.1)
-
-                while self._running:
-                    try:
-                        item = self.queue.get_nowait()
-                    except Empty:
-                        break
-                    else:
-                        item[0](self, *item[1], **item[2])
+                # sleep until our next step is due, unless there is already
+                # work waiting for us
+                if delay is None:
+                    delay = self.idle_wait
+                if delay > 0 and self.queue.empty():
+                    self._sleep(delay)
+
+                self._drain_queue()
         
         except Exception, e:
             with self.lock:
                 self._error = (e, format_exc())
                 self.log_debug("Thread for %s has crashed!" % self.__class__.__name__)
+                self.crashed()
                 if self._thread == None:
                     raise
         finally:
@@ -136,10 +377,65 @@ class Agent(object):
         # wait until _running is true
         while not self.running:
             time.sleep(0.1)
+
+    def start_pooled(self, pool):
+        """Run this agent on a shared runtime.WorkerPool instead of a thread
+        of its own. Returns immediately."""
+        with self.lock:
+            self._running = True
+            self._error = None
+            self._pool = pool
+            self._steps = None
+        pool.submit(self)
+
+    def _pool_step(self):
+        """Called by a WorkerPool thread to run the queued calls and the next
+        run() step. Returns how many seconds the agent may sleep before its
+        next step, or None once it has finished."""
+        if self._pool is None:
+            # a stale wakeup for an agent that has already finished
+            return None
+        self._step_thread = threading.current_thread()
+        try:
+            if self._steps is None:
+                self.log_debug("starting on the worker pool...")
+                self._steps = self.run()
+            self._drain_queue()
+            if not self._running:
+                raise StopIteration
+            started = time.time()
+            delay = self._steps.next()
+            self.stats.record('step', time.time() - started)
+        except StopIteration:
+            self._finish_pooled()
+            return None
+        except Exception, e:
+            with self.lock:
+                self._error = (e, format_exc())
+                self.log_debug("Pooled agent %s has crashed!" % self.__class__.__name__)
+                self.crashed()
+            self._finish_pooled()
+            return None
+        finally:
+            self._step_thread = None
+
+        if delay is None:
+            delay = self.idle_wait
+        if not self.queue.empty():
+            delay = 0
+        return delay
+
+    def _finish_pooled(self):
+        self.log_debug("stopping...")
+        with self.lock:
+            self._running = False
+            self._pool = None
+            self._steps = None
     
     def stop(self):
         with self.lock:
             self._running = False
+        self.wake()
 
     def log(self, level, *message):
         global stdout_lock
@@ -1,8 +1,56 @@
+import threading
 import time
 import traceback
 
 from agent import Agent
-from plugin import Plugin, ConfigurationError, ET
+from plugin import Plugin, AsyncPlugin, ConfigurationError, ET
+from dispatch import PatternScanner
+from runtime import Scheduler, WorkerPool
+from tasks import EventLoop
+from httpclient import shared_client
+
+class DispatchLane(Agent):
+    """One of the core's dispatch threads, see Core"""
+    def __init__(self, core):
+        super(DispatchLane, self).__init__(daemon=True)
+        self.core = core
+
+    @Agent.queued
+    def dispatch(self, chans, name, msg, direct, reply):
+        self.core._dispatch_incoming(chans, name, msg, direct, reply)
+
+    @Agent.queued
+    def dispatch_together(self, barrier, chans, name, msg, direct, reply):
+        if barrier.arrive():
+            try:
+                self.core._dispatch_incoming(chans, name, msg, direct, reply)
+            finally:
+                barrier.finish()
+
+class LaneBarrier(object):
+    """A message whose channels belong to several lanes. Each of those lanes
+    queues it, and it is dispatched once they have all reached it, so it
+    stays in order with the other messages on every one of its channels."""
+    def __init__(self, count):
+        self.cond = threading.Condition()
+        self.remaining = count
+        self.done = False
+
+    def arrive(self):
+        """Returns True in the last lane to arrive, which dispatches the
+        message. The others wait here until it has."""
+        with self.cond:
+            self.remaining -= 1
+            if self.remaining == 0:
+                return True
+            while not self.done:
+                self.cond.wait()
+            return False
+
+    def finish(self):
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
 
 class Core(Agent):
     """The core is an Agent that controls the main thread. Its job is to load
@@ -13,11 +61,52 @@ class Core(Agent):
 
     Similarly for when a plugin calls our send_outgoing() method.
 
+    Routing uses an index from channel to subscribed plugins. The index is
+    rebuilt whenever the plugin list or a plugin's subscriptions change, and
+    is published by swapping a single reference, so dispatch reads it without
+    taking any locks.
+
+    Plugins that only react to certain patterns (see
+    Plugin.incoming_filter()) have their patterns compiled into a shared
+    PatternScanner. Each message is scanned once, and those plugins only get
+    the messages that matched.
+
+    By default every plugin gets a thread of its own. If the <config> root
+    element has a pool-size attribute, plugins instead share that many worker
+    threads, except for plugins with dedicated_thread set (see Plugin).
+    AsyncPlugins always run as coroutines on the core's event loop.
+
+    Incoming messages are dispatched from the core's own thread, one at a
+    time. With a dispatch-workers attribute on the <config> root, they are
+    instead spread over that many DispatchLanes by channel, so messages on
+    one channel stay in order while a burst in one channel doesn't hold up
+    the others. A message on channels that belong to different lanes waits
+    until each of those lanes gets to it (see LaneBarrier), so it keeps its
+    place on all of them. Plugins that handle messages without queueing them
+    (commands_queued = False, or their own handle_incoming()) run in the
+    lane's thread, so they may be called from several lanes at once.
+
+    Plugins make HTTP requests through the core's shared HTTPClient, as
+    self.http. An http-timeout attribute on the <config> root sets how many
+    seconds plugins' requests may take by default.
+
     """
     @classmethod
     def load_from_file(cls, fname):
         config = ET.parse(fname).getroot()
-        c = Core()
+        try:
+            pool_size = int(config.get('pool-size', 0))
+        except ValueError:
+            raise ConfigurationError('pool-size must be an integer')
+        try:
+            dispatch_workers = int(config.get('dispatch-workers', 0))
+        except ValueError:
+            raise ConfigurationError('dispatch-workers must be an integer')
+        try:
+            http_timeout = float(config.get('http-timeout', 0))
+        except ValueError:
+            raise ConfigurationError('http-timeout must be a number')
+        c = Core(pool_size=pool_size, dispatch_workers=dispatch_workers, http_timeout=http_timeout)
         c.configfile = fname
         
         for el in config:
@@ -29,15 +118,38 @@ class Core(Agent):
         
         return c
         
-    def __init__(self):
+    def __init__(self, pool_size=0, dispatch_workers=0, http_timeout=0):
         super(Core, self).__init__()
+        self.scheduler = Scheduler()
+        if pool_size > 0:
+            self.pool = WorkerPool(pool_size, self.scheduler)
+        else:
+            self.pool = None
+        self.loop = EventLoop()
+        self.lanes = [DispatchLane(self) for i in range(dispatch_workers)]
+        # keeps multi-lane messages in the same order in every lane
+        self._lane_lock = threading.Lock()
+        self.http = shared_client()
+        # the client is shared with code outside the core, so the configured
+        # timeout goes with each plugin's requests instead of on the client
+        self.http_timeout = http_timeout if http_timeout > 0 else None
         self._plugins = []
+        # (channel -> tuple of plugins, plugin -> load order, plugin ->
+        # incoming filter, pattern scanner), replaced as a whole by
+        # _update_routes()
+        self._routes = ({}, {}, {}, PatternScanner([]))
     
     def start(self):
+        self.scheduler.start()
+        self.loop.start()
+        if self.pool:
+            self.pool.start()
+        for lane in self.lanes:
+            lane.start_threaded()
         with self.lock:
             for plug in self._plugins:
                 if not plug.running:
-                    plug.start_threaded()
+                    self._start_plugin(plug)
         
         try:
             super(Core, self).start()
@@ -46,6 +158,20 @@ class Core(Agent):
                 for plug in self._plugins:
                     if plug.running:
                         plug.stop()
+            for lane in self.lanes:
+                lane.stop()
+            if self.pool:
+                self.pool.stop()
+            self.loop.stop()
+            self.scheduler.stop()
+
+    def _start_plugin(self, plug):
+        if isinstance(plug, AsyncPlugin):
+            plug.start_on_loop(self.loop)
+        elif self.pool and not plug.dedicated_thread:
+            plug.start_pooled(self.pool)
+        else:
+            plug.start_threaded()
     
     def run(self):
         while True:
@@ -64,7 +190,8 @@ class Core(Agent):
                 
             for r in toremove:
                 self.remove_plugin(r)
-            yield
+            # plugins wake us up when they crash, see Plugin.crashed()
+            yield self.FOREVER
     
     #
     # plugin management
@@ -79,50 +206,146 @@ class Core(Agent):
         with self.lock:
             if not plug in self._plugins:
                 self._plugins.append(plug)
+                self._update_routes()
                 if self.running and not plug.running:
-                    plug.start_threaded()
+                    self._start_plugin(plug)
     
     def remove_plugin(self, plug, wait=False):
+        """Stops plug and forgets it. With wait, returns only once it has
+        finished; callers that wait should have a thread of their own, since
+        a plugin on the worker pool may need a free worker to finish."""
         with self.lock:
-            if plug in self._plugins:
-                self._plugins.remove(plug)
-                if plug.running:
-                    plug.stop()
-                    if wait:
-                        while plug.thread is not None:
-                            time.sleep(0.1)
+            if not plug in self._plugins:
+                return
+            self._plugins.remove(plug)
+            self._update_routes()
+            if not plug.running:
+                return
+            plug.stop()
+        # not under the lock, the plugin may need it to finish its step
+        if wait:
+            while plug.active:
+                time.sleep(0.1)
     
     def remove_all_plugins(self, wait=False):
         with self.lock:
             plugins_copy = list(self._plugins)
-            while len(self._plugins) > 0:
-                self.remove_plugin(self._plugins[0])
-            if wait:
-                while not all(map(lambda plugin: plugin.thread is None, plugins_copy)):
-                    time.sleep(0.1)
-                
+        for plug in plugins_copy:
+            self.remove_plugin(plug)
+        if wait:
+            while any(map(lambda plugin: plugin.active, plugins_copy)):
+                time.sleep(0.1)
+
+    def collect_stats(self):
+        """Returns a list of (name, stats summary) for the core and then each
+        plugin, see stats.AgentStats.summary()"""
+        result = [(self.__class__.__name__, self.stats.summary())]
+        for i, lane in enumerate(self.lanes):
+            result.append(('%s%d' % (lane.__class__.__name__, i), lane.stats.summary()))
+        for plug in self.plugins:
+            result.append((plug.__class__.__name__, plug.stats.summary()))
+        return result
+
+    #
+    # channel routing
+    #
+
+    def channels_changed(self, plug):
+        """Called by plugins whenever their subscriptions change"""
+        with self.lock:
+            if plug in self._plugins:
+                self._update_routes()
+
+    def _update_routes(self):
+        # must hold self.lock
+        routes = {}
+        order = {}
+        filters = dict(self._routes[2])
+        for i, plug in enumerate(self._plugins):
+            order[plug] = i
+            for chan in plug.channels:
+                routes.setdefault(chan, []).append(plug)
+            if not plug in filters:
+                filters[plug] = plug.incoming_filter()
+        for chan in routes:
+            routes[chan] = tuple(routes[chan])
+
+        if set(order) == set(self._routes[1]):
+            # only subscriptions changed, the patterns are still the same
+            scanner = self._routes[3]
+        else:
+            patterns = []
+            for plug in list(filters):
+                if not plug in order:
+                    del filters[plug]
+                elif filters[plug] is not None:
+                    patterns.extend((plug, p) for p in filters[plug].patterns)
+            scanner = PatternScanner(patterns)
+        self._routes = (routes, order, filters, scanner)
+
+    def route(self, chans):
+        """Returns the plugins subscribed to any of the given channels, in
+        the order they were loaded.
+
+        """
+        routes, order = self._routes[:2]
+        if len(chans) == 1:
+            for chan in chans:
+                return routes.get(chan, ())
+        found = set()
+        for chan in chans:
+            found.update(routes.get(chan, ()))
+        return sorted(found, key=order.get)
     
-    @Agent.queued
     def handle_incoming(self, chans, name, msg, direct, reply):
+        lanes = self.lanes
+        if lanes:
+            involved = sorted(set(hash(chan) % len(lanes) for chan in chans))
+            if not involved:
+                involved = [hash(None) % len(lanes)]
+            if len(involved) == 1:
+                lanes[involved[0]].dispatch(chans, name, msg, direct, reply)
+                return
+            barrier = LaneBarrier(len(involved))
+            # a lane calling us would run its part right away and wait for
+            # the others, so queue theirs first
+            current = threading.current_thread()
+            with self._lane_lock:
+                for i in involved:
+                    if lanes[i].thread is not current:
+                        lanes[i].dispatch_together(barrier, chans, name, msg, direct, reply)
+            for i in involved:
+                if lanes[i].thread is current:
+                    lanes[i].dispatch_together(barrier, chans, name, msg, direct, reply)
+        else:
+            self._dispatch_queued(chans, name, msg, direct, reply)
+
+    def _dispatch_incoming(self, chans, name, msg, direct, reply):
         toremove = []
-        for plug in self.plugins:
-            relevant_chans = set(plug.channels).intersection(set(chans))
-            if len(relevant_chans) > 0:
-                try:
-                    plug.handle_incoming(chans, name, msg, direct, reply)
-                except Exception:
-                    # An exception occurred in the main thread while calling
-                    # into the plugin's handle_incomming method
-                    traceback.print_exc()
-                    reply("Oh dear, there was a problem in the %s plugin. I'm shutting it down." %
-                            (plug.__class__.__name__,))
-                    # Can't remove the plugin while we're iterating over the list
-                    toremove.append(plug)
+        filters, scanner = self._routes[2:]
+        matched = None
+        for plug in self.route(chans):
+            filt = filters.get(plug)
+            if filt is not None and not filt.wants(direct):
+                if matched is None:
+                    matched = scanner.scan(msg)
+                if not plug in matched:
+                    continue
+            try:
+                plug.handle_incoming(chans, name, msg, direct, reply)
+            except Exception:
+                # An exception occurred in the main thread while calling
+                # into the plugin's handle_incomming method
+                traceback.print_exc()
+                reply("Oh dear, there was a problem in the %s plugin. I'm shutting it down." %
+                        (plug.__class__.__name__,))
+                # Can't remove the plugin while we're iterating over the list
+                toremove.append(plug)
         for r in toremove:
             self.remove_plugin(r)
+    _dispatch_queued = Agent.queued(_dispatch_incoming)
     
     @Agent.queued
     def send_outgoing(self, chan, msg):
-        for plug in self.plugins:
-            if chan in plug.channels:
-                plug.send_outgoing(chan, msg)
+        for plug in self._routes[0].get(chan, ()):
+            plug.send_outgoing(chan, msg)
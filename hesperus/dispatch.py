@@ -0,0 +1,268 @@
+import re
+import sre_parse
+from sre_constants import LITERAL, IN, SUBPATTERN, BRANCH, AT, AT_BEGINNING, AT_BEGINNING_STRING, \
+        GROUPREF, GROUPREF_EXISTS
+
+# patterns that would expand into more literal prefixes than this are
+# treated as if they had no literal prefix at all
+MAX_PREFIXES = 64
+
+# the re module can't compile patterns with more groups than this, so the
+# scanner splits its combined matchers to stay below it
+MAX_GROUPS = 90
+
+def _char(code):
+    if code < 256:
+        return chr(code)
+    return unichr(code)
+
+def _literal_prefixes(items):
+    """Walks a parsed regular expression and returns (prefixes, complete).
+    prefixes is a list of the literal strings any match must start with, and
+    complete is True if the items matched nothing but those literals.
+
+    """
+    prefixes = ['']
+    for op, av in items:
+        if op == LITERAL:
+            sub, complete = [_char(av)], True
+        elif op == AT and av in (AT_BEGINNING, AT_BEGINNING_STRING):
+            continue
+        elif op == IN and all(o == LITERAL for o, _ in av):
+            sub, complete = [_char(a) for _, a in av], True
+        elif op == SUBPATTERN:
+            sub, complete = _literal_prefixes(av[-1])
+        elif op == BRANCH:
+            sub, complete = [], True
+            for branch in av[1]:
+                bsub, bcomplete = _literal_prefixes(branch)
+                sub.extend(bsub)
+                complete = complete and bcomplete
+        else:
+            return prefixes, False
+
+        prefixes = [p + s for p in prefixes for s in sub]
+        if len(prefixes) > MAX_PREFIXES:
+            return [''], False
+        if not complete:
+            return prefixes, False
+    return prefixes, True
+
+def literal_prefixes(regexp):
+    """Returns the set of literal strings that every match of the compiled
+    regexp must start with, or None if there is no such set (the pattern can
+    start with anything, or is case-insensitive).
+
+    """
+    if regexp.flags & re.IGNORECASE:
+        return None
+    try:
+        prefixes, _ = _literal_prefixes(sre_parse.parse(regexp.pattern, regexp.flags))
+    except Exception:
+        # sre_parse is an implementation detail, don't let it break dispatch
+        return None
+    if '' in prefixes:
+        return None
+    return set(prefixes)
+
+class PrefixIndex(object):
+    """An index of command handlers by the literal prefix of their regexp.
+
+    Handlers without a usable prefix, such as catch-all patterns like (\S+)
+    or pattern handlers that search anywhere in the line, go in a fallback
+    bucket and are candidates for every message.
+
+    """
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.fallback = []
+        self.by_prefix = {}
+        for i, func in enumerate(handlers):
+            regexp = getattr(func, '_hesperus_regexp', None)
+            prefixes = literal_prefixes(regexp) if regexp is not None else None
+            if prefixes is None:
+                self.fallback.append(i)
+                continue
+            for prefix in prefixes:
+                self.by_prefix.setdefault(prefix, []).append(i)
+        self.lengths = sorted(set(len(p) for p in self.by_prefix))
+
+    def candidates(self, msg):
+        """Returns the handlers that could match msg, in dispatch order"""
+        found = None
+        for length in self.lengths:
+            if length > len(msg):
+                break
+            matches = self.by_prefix.get(msg[:length])
+            if matches:
+                if found is None:
+                    found = set(self.fallback)
+                found.update(matches)
+        if found is None:
+            return [self.handlers[i] for i in self.fallback]
+        return [self.handlers[i] for i in sorted(found)]
+
+class CommandTable(object):
+    """The command handlers of a CommandPlugin subclass, collected once and
+    kept in dispatch order.
+
+    Handlers are the methods marked with _hesperus_command by the
+    register_command and register_pattern decorators. They are tried in the
+    order dir() lists them, which is the order CommandPlugin has always used.
+    Handlers are looked up by the literal prefix of their regexp, so only the
+    ones that could possibly match a message get to run their regexp.
+
+    Tables are cached on the class itself. Reloading a plugin's module creates
+    a brand new class, so a reload always gets a freshly built table.
+
+    """
+    def __init__(self, plugcls):
+        self.handlers = []
+        for attr in dir(plugcls):
+            func = getattr(plugcls, attr, None)
+            # unwrap unbound methods so we can call them with any instance
+            func = getattr(func, 'im_func', func)
+            if getattr(func, '_hesperus_command', False):
+                self.handlers.append(func)
+
+        # non-direct messages never reach direct-only commands, so they get
+        # an index without them
+        self._direct = PrefixIndex(self.handlers)
+        self._indirect = PrefixIndex([func for func in self.handlers
+                if not getattr(func, '_hesperus_direct_only', False)])
+
+        # what the core's PatternScanner needs to know to skip this plugin
+        self.patterns = []
+        self.wants_direct = False
+        self.wants_indirect = False
+        for func in self.handlers:
+            pattern = getattr(func, '_hesperus_pattern', None)
+            if pattern is not None:
+                self.patterns.append(pattern)
+            elif getattr(func, '_hesperus_regexp', None) is None:
+                # some hand-made handler, it could want anything
+                self.wants_direct = self.wants_indirect = True
+            else:
+                self.wants_direct = True
+                if not func._hesperus_direct_only:
+                    self.wants_indirect = True
+
+    def wants(self, direct):
+        """True if every message of this kind must be delivered, whether or
+        not one of our patterns matches it.
+
+        """
+        return self.wants_direct if direct else self.wants_indirect
+
+    @classmethod
+    def for_class(cls, plugcls):
+        # look in the class's own __dict__ so subclasses don't pick up the
+        # table of their parent class
+        table = plugcls.__dict__.get('_hesperus_command_table')
+        if table is None:
+            table = cls(plugcls)
+            plugcls._hesperus_command_table = table
+        return table
+
+    def dispatch(self, plugin, chans, name, msg, direct, reply):
+        """Call handlers until one of them claims the message. Returns True if
+        one did.
+
+        """
+        index = self._direct if direct else self._indirect
+        for func in index.candidates(msg):
+            if func(plugin, chans, name, msg, direct, reply):
+                return True
+        return False
+
+def _subpatterns(av):
+    if isinstance(av, sre_parse.SubPattern):
+        yield av
+    elif isinstance(av, (list, tuple)):
+        for item in av:
+            for sub in _subpatterns(item):
+                yield sub
+
+def _has_backrefs(items):
+    for op, av in items:
+        if op in (GROUPREF, GROUPREF_EXISTS):
+            return True
+        if any(_has_backrefs(sub) for sub in _subpatterns(av)):
+            return True
+    return False
+
+class PatternScanner(object):
+    """Finds out which plugins have a passive pattern matching a message by
+    scanning it with one combined regexp instead of one search per plugin.
+
+    The scanner is built from (owner, pattern) pairs. Patterns with the same
+    flags are joined into a single alternation that acts as a prefilter: if it
+    doesn't match, none of its members can, which is the common case. If it
+    does match, its members are searched one by one to find every owner that
+    matched, since an alternation only reports one of them.
+
+    Patterns that match the empty string match every message, so their owners
+    are always reported without scanning. Patterns with backreferences can't
+    be combined safely and are searched on their own.
+
+    """
+    def __init__(self, entries):
+        self.always = set()
+        self.matchers = []
+
+        byflags = {}
+        for owner, pattern in entries:
+            if pattern.search('') is not None:
+                self.always.add(owner)
+                continue
+            byflags.setdefault(pattern.flags, []).append((owner, pattern))
+
+        for flags, members in byflags.iteritems():
+            bucket, names, groups = [], set(), 0
+            for owner, pattern in members:
+                if self._is_standalone(pattern):
+                    self.matchers.append((None, [(owner, pattern)]))
+                    continue
+                pnames = set(pattern.groupindex)
+                if bucket and (names & pnames or groups + pattern.groups > MAX_GROUPS):
+                    self.matchers.append(self._combine(bucket, flags))
+                    bucket, names, groups = [], set(), 0
+                bucket.append((owner, pattern))
+                names |= pnames
+                groups += pattern.groups
+            if bucket:
+                self.matchers.append(self._combine(bucket, flags))
+
+    @staticmethod
+    def _is_standalone(pattern):
+        if pattern.groups > MAX_GROUPS:
+            return True
+        try:
+            return _has_backrefs(sre_parse.parse(pattern.pattern, pattern.flags))
+        except Exception:
+            return True
+
+    @staticmethod
+    def _combine(members, flags):
+        if len(members) == 1:
+            return (None, members)
+        sources = []
+        for _, pattern in members:
+            if pattern.pattern not in sources:
+                sources.append(pattern.pattern)
+        try:
+            combined = re.compile('|'.join('(?:%s)' % p for p in sources), flags)
+        except (re.error, AssertionError):
+            combined = None
+        return (combined, members)
+
+    def scan(self, msg):
+        """Returns the set of owners with at least one pattern matching msg"""
+        matched = set(self.always)
+        for combined, members in self.matchers:
+            if combined is not None and combined.search(msg) is None:
+                continue
+            for owner, pattern in members:
+                if owner not in matched and pattern.search(msg) is not None:
+                    matched.add(owner)
+        return matched
@@ -0,0 +1,94 @@
+"""The HTTP client plugins share.
+
+The core has one HTTPClient, and each plugin gets at it through its http
+property, which records the plugin's requests in its stats. Code that isn't
+a plugin, such as shorturl, uses shared_client() directly.
+
+"""
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+class HTTPClient(object):
+    """A requests Session that keeps up to pool_size connections to each host
+    open between requests, instead of a new connection and TLS handshake
+    every time.
+
+    Requests time out after timeout seconds unless they say otherwise, a
+    (connect, read) pair as requests takes it, so a server that stops
+    answering can't hang a plugin forever. Responses may come gzipped.
+
+    """
+    def __init__(self, timeout=(5.0, 30.0), pool_size=10):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+    def request(self, method, url, stats=None, **kwargs):
+        """Like requests.request(). With stats, an AgentStats, the request's
+        time goes in its http histogram, failures are counted as http_errors
+        and the size of the body as http_bytes."""
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.time()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            if stats is not None:
+                stats.record('http', time.time() - start)
+                stats.count('http_errors')
+            raise
+        if stats is not None:
+            stats.record('http', time.time() - start)
+            if not kwargs.get('stream'):
+                stats.count('http_bytes', len(response.content))
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def for_agent(self, agent, timeout=None):
+        return AgentHTTP(self, agent.stats, timeout)
+
+class AgentHTTP(object):
+    """An HTTPClient that records requests in one agent's stats. With a
+    timeout, that is the default for its requests instead of the client's."""
+    def __init__(self, client, stats, timeout=None):
+        self.client = client
+        self.stats = stats
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if self.timeout is not None:
+            kwargs.setdefault('timeout', self.timeout)
+        return self.client.request(method, url, stats=self.stats, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def get_json(self, url, **kwargs):
+        """GETs url and decodes it as JSON, raising requests.HTTPError if the
+        server answered with an error"""
+        response = self.get(url, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared_client():
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = HTTPClient()
+        return _shared
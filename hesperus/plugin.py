@@ -1,8 +1,15 @@
 from agent import Agent
+from dispatch import CommandTable
+from tasks import CancelledError
 from xml.etree import ElementTree as ET
+from types import GeneratorType
+import threading
 import time
 from copy import copy
 import traceback
+import inspect
+import random
+import math
 import re
 import json
 
@@ -37,8 +44,24 @@ class Plugin(Agent):
     handle_incoming(), or by calling parent.send_outgoing() to relay a message
     to the IRC plugin.
 
+    When the core runs plugins on a shared worker pool, a plugin whose run()
+    or handlers block for long stretches should set dedicated_thread to keep
+    a thread of its own. This can also be set per plugin in the config with a
+    thread="dedicated" (or thread="pooled") attribute.
+
+    A plugin that can fall behind can bound its queue of pending calls with
+    queue-size and queue-policy attributes, see agent.AgentQueue. A plugin
+    that drops calls then only degrades itself instead of blocking the core,
+    which delivers messages to every plugin.
+
+    PollPlugins, and AsyncPlugins that poll, also take a poll-jitter
+    attribute, see PollPlugin.
+
     """
 
+    # if True, never run this plugin on the core's worker pool
+    dedicated_thread = False
+
     @classmethod
     def load_plugin(cls, core, el):
         plug_type = el.get('type', 'plugin.Plugin')
@@ -47,6 +70,27 @@ class Plugin(Agent):
         plug_channels = filter(lambda s: len(s) > 0, plug_channels)
         plug_channels = map(lambda s: s.strip(), plug_channels)
 
+        plug_thread = el.get('thread', None)
+        if plug_thread is not None and not plug_thread.lower() in ('dedicated', 'pooled'):
+            raise ConfigurationError('thread must be "dedicated" or "pooled"')
+
+        plug_poll_jitter = el.get('poll-jitter', None)
+        if plug_poll_jitter is not None:
+            try:
+                plug_poll_jitter = float(plug_poll_jitter)
+            except ValueError:
+                raise ConfigurationError('poll-jitter must be a number')
+            if not 0 <= plug_poll_jitter < 1:
+                raise ConfigurationError('poll-jitter must be at least 0 and less than 1')
+
+        plug_queue_policy = el.get('queue-policy', None)
+        plug_queue_size = el.get('queue-size', None)
+        if plug_queue_size is not None:
+            try:
+                plug_queue_size = int(plug_queue_size)
+            except ValueError:
+                raise ConfigurationError('queue-size must be an integer')
+
         kwargs = {}
         for subel in el:
             nice_tag = subel.tag.lower().replace('-', '_')
@@ -80,6 +124,19 @@ class Plugin(Agent):
         for chan in plug_channels:
             plug.subscribe(chan)
 
+        if plug_thread is not None:
+            plug.dedicated_thread = plug_thread.lower() == 'dedicated'
+
+        if plug_poll_jitter is not None:
+            if not isinstance(plug, (PollPlugin, AsyncPlugin)):
+                raise ConfigurationError('poll-jitter only applies to poll plugins')
+            plug.poll_jitter = plug_poll_jitter
+
+        try:
+            plug.queue.configure(plug_queue_size, plug_queue_policy)
+        except ValueError, e:
+            raise ConfigurationError(str(e))
+
         return plug
 
     def __init__(self, parent, channels=[], daemon=False):
@@ -87,6 +144,15 @@ class Plugin(Agent):
         self._channels = copy(channels)
         self.parent = parent
 
+    def crashed(self):
+        # let the core notice the crash right away instead of at its next poll
+        self.parent.wake()
+
+    @property
+    def http(self):
+        """The core's HTTP client, recording our requests in self.stats"""
+        return self.parent.http.for_agent(self, self.parent.http_timeout)
+
     # useful decorator for config type checking
     @classmethod
     def config_types(cls, **types):
@@ -138,15 +204,18 @@ class Plugin(Agent):
         with self.lock:
             if not chan in self._channels:
                 self._channels.append(chan)
+        self.parent.channels_changed(self)
 
     def unsubscribe(self, chan):
         with self.lock:
             if chan in self._channels:
                 self._channels.remove(chan)
+        self.parent.channels_changed(self)
 
     def unsubscribe_all(self):
         with self.lock:
             self._channels = []
+        self.parent.channels_changed(self)
 
     # override in subclasses, use Plugin.queued when appropriate
 
@@ -168,6 +237,15 @@ class Plugin(Agent):
         #self.log_debug("outgoing", self, chan, msg)
         pass
 
+    def incoming_filter(self):
+        """Lets the core skip messages this plugin would ignore anyway.
+        Return None to get every message on our channels, or an object with a
+        patterns list and a wants(direct) method; see dispatch.CommandTable.
+        The core then only delivers messages that match one of the patterns
+        unless wants() returns True for them. This is called when the plugin
+        is added to the core, so the answer must not change afterwards."""
+        return None
+
 # special case of Plugin that just handles chat commands, given as regexps
 class CommandPlugin(Plugin):
     """Plugins deriving from this class are meant to implement a command that
@@ -202,13 +280,20 @@ class CommandPlugin(Plugin):
                 match = regexp.match(msg)
                 if not match:
                     return False
-                func(self, chans, name, match, direct, reply)
+                self._handler_returned(func(self, chans, name, match, direct, reply))
                 return True
 
             sub_function._hesperus_command = True
+            # used by CommandTable to index commands by their literal prefix
+            sub_function._hesperus_regexp = regexp
+            sub_function._hesperus_direct_only = direct_only
             return sub_function
         return sub_generator
 
+    # AsyncPlugin overrides this to run handlers that are coroutines
+    def _handler_returned(self, result):
+        return result
+
     def handle_incoming(self, *args):
         if self.commands_queued:
             self.handle_incoming_queued(*args)
@@ -216,28 +301,67 @@ class CommandPlugin(Plugin):
             self.handle_incoming_nonqueued(*args)
 
     def handle_incoming_nonqueued(self, chans, name, msg, direct, reply):
-        for func in dir(self):
-            func = getattr(self, func)
-            if (not "_hesperus_command" in dir(func)) or (not func._hesperus_command):
-                continue
-            if func(chans, name, msg, direct, reply):
-                return
+        CommandTable.for_class(self.__class__).dispatch(self, chans, name, msg, direct, reply)
     handle_incoming_queued = Plugin.queued(handle_incoming_nonqueued)
 
+    def incoming_filter(self):
+        # subclasses that handle messages themselves need to see all of them
+        cls = self.__class__
+        if cls.handle_incoming.im_func is not CommandPlugin.handle_incoming.im_func or \
+                cls.handle_incoming_nonqueued.im_func is not CommandPlugin.handle_incoming_nonqueued.im_func:
+            return None
+        return CommandTable.for_class(cls)
+
 # special case of plugin that polls every X seconds
 class PollPlugin(Plugin):
+    """Calls poll() every poll_interval seconds. Between polls the plugin
+    sleeps until the next one is due, waking early only for queued calls; on
+    the worker pool the core's scheduler wakes it. poll_interval may be a
+    property, it is read again every time the plugin wakes up.
+
+    So that pollers started together don't keep polling together, each wait
+    is randomly stretched or shrunk by up to poll_jitter times the interval
+    (set per plugin with a poll-jitter attribute), and the first poll is
+    offset by a phase that spreads pollers with similar intervals evenly
+    over the interval.
+
+    """
     poll_interval = 5.0
+    poll_jitter = 0.1
+
+    # how many phases have been handed out, per group of similar intervals
+    _phase_lock = threading.Lock()
+    _phase_counts = {}
+
+    @classmethod
+    def next_phase(cls, interval):
+        """Returns a fraction of the interval to offset a new poller by.
+        Successive pollers in an interval group follow the golden ratio
+        sequence, which stays evenly spread however many there are."""
+        # groups are half an octave wide
+        group = int(round(math.log(max(interval, 0.001), 2) * 2))
+        with PollPlugin._phase_lock:
+            k = PollPlugin._phase_counts.get(group, 0)
+            PollPlugin._phase_counts[group] = k + 1
+        return (k * 0.6180339887) % 1.0
 
     def run(self):
-        self.lasttime = time.time()
+        # the first poll comes after between half and one and a half
+        # intervals, depending on our phase
+        interval = self.poll_interval
+        self.lasttime = time.time() - interval * (0.5 - self.next_phase(interval))
+        stretch = 1.0
         while True:
-            while time.time() < self.lasttime + self.poll_interval:
-                yield
+            delay = self.lasttime + self.poll_interval * stretch - time.time()
+            if delay > 0:
+                yield delay
+                continue
 
-            for _ in self.poll():
-                yield
+            for step in self.poll():
+                yield step
 
             self.lasttime = time.time()
+            stretch = 1.0 + random.uniform(-self.poll_jitter, self.poll_jitter)
 
     def poll(self):
         yield
@@ -255,24 +379,181 @@ class PassivePlugin(CommandPlugin):
         if ignore_direct is true, ignores messages that are directed
         specifically at us
 
+        The method takes either (self, match, reply) or, like a command,
+        (self, chans, name, match, direct, reply).
+
         """
         pattern = re.compile(regexp)
         def wrapper(func):
+            # decided once here, so a TypeError from inside the handler
+            # isn't mistaken for the wrong signature
+            short_form = len(inspect.getargspec(func).args) == 3
             def wrapped(self, chans, name, msg, direct, reply):
                 if direct and ignore_direct:
                     return False
                 match = pattern.search(msg)
                 if match:
-                    try:
-                        return func(self, match, reply)
-                    except TypeError:
-                        return func(self, chans, name, match, direct, reply)
+                    if short_form:
+                        result = func(self, match, reply)
+                    else:
+                        result = func(self, chans, name, match, direct, reply)
+                    return self._handler_returned(result)
                 else:
                     return False
             wrapped._hesperus_command = True
+            # lets the core scan for all plugins' patterns in one pass
+            wrapped._hesperus_pattern = pattern
             return wrapped
         return wrapper
 
+class AsyncPlugin(CommandPlugin):
+    """A plugin whose code runs as coroutines on the core's event loop (see
+    tasks.py) instead of in a thread of its own. While one command waits on
+    the network, other commands and plugins carry on.
+
+    Commands and patterns are registered as usual and may be coroutines, as
+    may incoming() and poll(). Blocking calls go through run_in_executor():
+
+        @AsyncPlugin.register_command(r'fetch\s+(\S+)')
+        def fetch(self, chans, name, match, direct, reply):
+            page = yield self.run_in_executor(urllib2.urlopen, match.group(1))
+            reply(page.read(100))
+
+    If poll_interval is set, poll() is run that often, with the same phase
+    and poll_jitter as a PollPlugin's polls. run() is hosted on the
+    loop as well and its yields keep their usual Agent meaning, so generator
+    style plugins can move over unchanged. Queued calls also run on the loop.
+
+    A coroutine that raises crashes the plugin, just like an exception in a
+    plugin's thread would.
+
+    """
+    poll_interval = None
+    poll_jitter = 0.1
+
+    def __init__(self, parent, *args, **kwargs):
+        super(AsyncPlugin, self).__init__(parent, *args, **kwargs)
+        self._loop = None
+        self._tasks = set()
+
+    @property
+    def loop(self):
+        return self._loop
+
+    @property
+    def active(self):
+        with self.lock:
+            return self._loop is not None or super(AsyncPlugin, self).active
+
+    def start_on_loop(self, loop):
+        """Called by the core to run this plugin on its tasks.EventLoop.
+        Returns immediately."""
+        with self.lock:
+            self._running = True
+            self._error = None
+            self._loop = loop
+        loop.call_soon(self._attach)
+
+    def _attach(self):
+        # queued calls made from the loop thread can run right away
+        self._step_thread = threading.current_thread()
+        self.log_debug("starting on the event loop...")
+        self.spawn(self.run(), idle_delay=self.idle_wait)
+        if self.poll_interval is not None:
+            self.spawn(self._poll_forever())
+        self._drain_queue()
+
+    def _poll_forever(self):
+        # the first poll comes after between half and one and a half
+        # intervals, like a PollPlugin's
+        interval = self.poll_interval
+        delay = interval * (0.5 + PollPlugin.next_phase(interval))
+        while True:
+            yield delay
+            result = self.poll()
+            if isinstance(result, GeneratorType):
+                yield result
+            delay = self.poll_interval * (1.0 + random.uniform(-self.poll_jitter, self.poll_jitter))
+
+    def stop(self):
+        with self.lock:
+            self._running = False
+            loop = self._loop
+        if loop is not None:
+            loop.call_soon(self._detach)
+
+    def _detach(self):
+        for task in list(self._tasks):
+            task.cancel()
+        self._step_thread = None
+        self.log_debug("stopping...")
+        with self.lock:
+            self._loop = None
+
+    def wake(self):
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon(self._drain_queue)
+        else:
+            super(AsyncPlugin, self).wake()
+
+    def spawn(self, coro, idle_delay=0):
+        """Runs a coroutine on the loop on behalf of this plugin and returns
+        its tasks.Task"""
+        task = self._loop.spawn(coro, idle_delay)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        exc_info = task.exc_info()
+        if exc_info is None or exc_info[0] is CancelledError or not self._running:
+            return
+        with self.lock:
+            self._error = (exc_info[1], ''.join(traceback.format_exception(*exc_info)))
+            self.log_debug("Task for %s has crashed!" % self.__class__.__name__)
+            self.crashed()
+
+    def run_in_executor(self, func, *args, **kwargs):
+        """Runs a blocking call off the loop; yield the returned future to
+        wait for its result"""
+        return self._loop.run_in_executor(func, *args, **kwargs)
+
+    def _handler_returned(self, result):
+        if isinstance(result, GeneratorType):
+            self.spawn(result)
+            # there's no telling yet whether it handled the line
+            return False
+        return result
+
+    def handle_incoming(self, chans, name, msg, direct, reply):
+        # called from the core's thread, hop over to the loop
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon(self._incoming, time.time(), chans, name, msg, direct, reply)
+
+    def _incoming(self, queued_at, chans, name, msg, direct, reply):
+        if self._running:
+            started = time.time()
+            self.stats.record('enqueue_delay', started - queued_at)
+            self._handler_returned(self.incoming(chans, name, msg, direct, reply))
+            self.stats.record('handler', time.time() - started)
+
+    def incoming(self, chans, name, msg, direct, reply):
+        """Handles a message on the loop, may be a coroutine. By default,
+        runs the registered commands and patterns."""
+        CommandTable.for_class(self.__class__).dispatch(self, chans, name, msg, direct, reply)
+
+    def incoming_filter(self):
+        cls = self.__class__
+        if cls.incoming.im_func is not AsyncPlugin.incoming.im_func:
+            return None
+        return CommandTable.for_class(cls)
+
+    def poll(self):
+        pass
+
 class PersistentPlugin(Plugin):
     persistence_file = 'global.json'
     _data = {}
@@ -1,19 +1,18 @@
-from ..plugin import CommandPlugin
+from ..plugin import AsyncPlugin
 from ..shorturl import short_url
 
-import requests
 import datetime
 import random
 
 API_VERSION_HEADER = {'CB-VERSION': '2017-12-01'}
 
-class CoinPricePlugin(CommandPlugin):
-    @CommandPlugin.config_types()
+class CoinPricePlugin(AsyncPlugin):
+    @AsyncPlugin.config_types()
     def __init__(self, core):
         super(CoinPricePlugin, self).__init__(core)
         pass
 
-    @CommandPlugin.register_command(r'(btc|eth|ltc|bch)(?:\s+(\w+))?')
+    @AsyncPlugin.register_command(r'(btc|eth|ltc|bch)(?:\s+(\w+))?')
     def price_command(self, chans, name, match, direct, reply):
         coin = match.group(1).upper()
         # HI ACHIN
@@ -25,10 +24,17 @@ class CoinPricePlugin(CommandPlugin):
             currency = match.group(2).upper()
         yesterday_date = (datetime.date.today() - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
         try:
-            resp = requests.get('https://api.coinbase.com/v2/prices/{}-{}/spot'.format(
-                coin, currency), headers=API_VERSION_HEADER).json()
-            prev = requests.get('https://api.coinbase.com/v2/prices/{}-{}/spot?date={}'.format(
-                coin, currency, yesterday_date), headers=API_VERSION_HEADER).json()
+            # fetch both prices at once
+            http = self.http
+            resp, prev = yield [
+                self.run_in_executor(http.get_json,
+                    'https://api.coinbase.com/v2/prices/{}-{}/spot'.format(coin, currency),
+                    headers=API_VERSION_HEADER),
+                self.run_in_executor(http.get_json,
+                    'https://api.coinbase.com/v2/prices/{}-{}/spot?date={}'.format(
+                        coin, currency, yesterday_date),
+                    headers=API_VERSION_HEADER),
+            ]
             prev = prev['data']['amount']
             msg = 'Current {} price is {} {}'.format(
                 coin, resp['data']['amount'], resp['data']['currency'])
@@ -1,4 +1,5 @@
-from ..plugin import Plugin, CommandPlugin, PollPlugin
+from ..plugin import Plugin, CommandPlugin, PollPlugin, AsyncPlugin
+from ..tasks import Return
 import time
 
 # a simple command-based plugin, note all commands will
@@ -27,6 +28,32 @@ class ExamplePollPlugin(PollPlugin):
             self.parent.send_outgoing(chan, "poll every 5 seconds")
         yield
 
+# a coroutine-based plugin, commands and polls run on the core's event loop
+# instead of a thread of their own. yield a future to wait for it without
+# holding anything else up, and send blocking calls to run_in_executor()
+class ExampleAsyncPlugin(AsyncPlugin):
+    poll_interval = 5.0
+
+    @AsyncPlugin.register_command("slow (.*)")
+    def slow_command(self, chans, name, match, direct, reply):
+        # other commands keep running while this one waits
+        yield self.run_in_executor(time.sleep, 2)
+        reply("done waiting for %s" % (match.group(1),))
+
+    @AsyncPlugin.register_command("both")
+    def both_command(self, chans, name, match, direct, reply):
+        # yield a list to wait for several things at once
+        first, second = yield [self.fetch("one"), self.fetch("two")]
+        reply("got %s and %s" % (first, second))
+
+    def fetch(self, what):
+        yield self.run_in_executor(time.sleep, 1)
+        raise Return(what.upper())
+
+    def poll(self):
+        for chan in self.channels:
+            self.parent.send_outgoing(chan, "poll every 5 seconds")
+
 # a configuration-reading plugin
 # will read
 #####################################
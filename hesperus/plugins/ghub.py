@@ -1,12 +1,11 @@
-import urllib2
-from urllib import urlencode
-import json
 import re
 from time import time, sleep
 
+import requests
+
 from ..plugin import PollPlugin, CommandPlugin
 from ..core import ET, ConfigurationError
-from ..shorturl import short_url
+from ..shorturl import short_url, short_urls
 _short_url = lambda u: short_url(u, provider="git.io")
 
 # how each event is printed.
@@ -79,9 +78,13 @@ class MiniGithubAPI(object):
     this returns the JSON. GET requests only, no authentication, just data
     retrieval.
 
+    Requests go through http, a plugin's HTTP client (see
+    hesperus.httpclient), so they share its connections and timeouts.
+
     See http://developer.github.com/v3/
     """
-    def __init__(self, baseurl=None, delay=1.0):
+    def __init__(self, http, baseurl=None, delay=1.0):
+        self.http = http
         if not baseurl:
             self.baseurl = "https://api.github.com"
         else:
@@ -111,26 +114,21 @@ class MiniGithubAPI(object):
             sleep(self.lasttime + self.delay - time())
         self.lasttime = time()
 
-        if args:
-            argstring = "?" + urlencode(args)
-        else:
-            argstring = ""
-
-        completeurl = url + argstring
-        reqobj = urllib2.Request(completeurl)
+        headers = {}
         if raw:
-            reqobj.add_header("Accept", "application/vnd.github.raw")
+            headers["Accept"] = "application/vnd.github.raw"
         try:
-            request = urllib2.urlopen(reqobj)
-        except Exception, e:
-            # Who knows what urlopen can raise... it doesn't seem to be clear.
-            # urllib2.URLError, urllib.HTTPError, maybe some other stuff? I'm
-            # disappointed in you, Python standard library!
+            response = self.http.get(url, params=args, headers=headers)
+            response.raise_for_status()
+        except requests.RequestException, e:
             raise NoData(str(e))
 
         if raw:
-            return request.read()
-        return json.load(request)
+            return response.content
+        try:
+            return response.json()
+        except ValueError, e:
+            raise NoData(str(e))
     
 class Feed(object):
     def __init__(self, url, channels, gh3):
@@ -203,7 +201,7 @@ class GitHubPlugin(PollPlugin, CommandPlugin):
     def __init__(self, core, feedmap=None, default_user="agrif", default_repo="hesperus"):
         super(GitHubEventMonitorV3, self).__init__(core)
 
-        self.gh3 = MiniGithubAPI()
+        self.gh3 = MiniGithubAPI(self.http)
         
         self.default_user = default_user
         self.default_repo = default_repo
@@ -291,7 +289,7 @@ class GitHubPlugin(PollPlugin, CommandPlugin):
             tree = self.gh3.query("/repos/{user}/{repo}/git/trees/{branch}".format(
                 user=user,repo=repo,branch=branch),
                     dict(recursive=1))
-        except urllib2.HTTPError:
+        except NoData:
             reply("I couldn't find that user or branch. Sorry!")
             return
 
@@ -394,9 +392,9 @@ class GitHubPlugin(PollPlugin, CommandPlugin):
         """
 
         for feed in self.feeds.itervalues():
-            for event in feed.get_new_events():
-                if not self._preprocess_event(event):
-                    continue
+            events = [event for event in feed.get_new_events() if self._preprocess_event(event)]
+            self._shorten_links(events)
+            for event in events:
                 # Call to the appropriate event handler
                 if event['type'] in DEFAULT_FORMATS:
                     reply = DEFAULT_FORMATS[event['type']].format(**event)
@@ -412,11 +410,7 @@ class GitHubPlugin(PollPlugin, CommandPlugin):
                 return False
             payload['comment']['body'] = _trunc(payload['comment']['body'])
             if 'issue' in payload:
-                payload['issue']['html_url'] = short_url(payload['issue']['html_url'] + '#issuecomment-' + str(payload['comment']['id']))
-        
-        if 'issue' in payload and 'html_url' in payload['issue']:
-            if not 'comment' in payload:
-                payload['issue']['html_url'] = _short_url(payload['issue']['html_url'])
+                payload['issue']['html_url'] += '#issuecomment-' + str(payload['comment']['id'])
         
         if 'ref' in payload:
             payload['ref'] = _nice_ref(payload['ref'])
@@ -442,10 +436,25 @@ class GitHubPlugin(PollPlugin, CommandPlugin):
             payload['message'] = commitmsg
             event['type'] = 'SinglePushEvent'
         
-        url = "https://github.com/{repo}/compare/{before}...{head}".format(repo=event['repo']['name'], before=payload['before'], head=payload['head'])
-        payload['url'] = _short_url(url)
+        payload['url'] = "https://github.com/{repo}/compare/{before}...{head}".format(repo=event['repo']['name'], before=payload['before'], head=payload['head'])
         
         return True
 
+    def _shorten_links(self, events):
+        """Shortens the links of all the events in one batch, so a poll with
+        many new events doesn't wait on one request after another"""
+        links = []
+        for event in events:
+            payload = event['payload']
+            if 'issue' in payload and 'html_url' in payload['issue']:
+                # comment links go to the default provider, the rest to git.io
+                provider = None if 'comment' in payload else 'git.io'
+                links.append((payload['issue'], 'html_url', provider))
+            if event['type'] in ('PushEvent', 'SinglePushEvent'):
+                links.append((payload, 'url', 'git.io'))
+        shortened = short_urls([(d[key], provider) for d, key, provider in links])
+        for (d, key, provider), short in zip(links, shortened):
+            d[key] = short
+
 # backwards compatibility
 GitHubEventMonitorV3 = GitHubPlugin
@@ -1,52 +1,525 @@
 from ..core import ConfigurationError, ET
 from ..plugin import Plugin
 from irc.bot import SingleServerIRCBot as IRCBot
+from irc.client import ServerNotConnectedError
+from collections import deque
+import datetime
+import random
 import re
 import string
+import threading
 import time
+import traceback
 import irc.strings
 
-class RateLimit(object):
-    """If 5 lines come in less than 2 seconds, sleep for 2 seconds"""
-    def __init__(self, waittime=2):
-        self.waittime = waittime
-        self.lastmsg = 0
-        # Number of messages that have come in since lastmsg
-        self.msgcount = 0
-
-    def call(self):
-        now = time.time()
-        if now - self.lastmsg > self.waittime:
-            # Nothing received in waittime seconds. No delay.
-            self.lastmsg = now
-            self.msgcount = 0
+class TokenBucket(object):
+    """Allows bursts of up to capacity tokens, refilled at rate per second"""
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.last = time.time()
 
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self, amount, now):
+        """Returns how many seconds until amount tokens are available"""
+        self._refill(now)
+        # something bigger than the whole bucket goes out once it is full
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity)
+
+# priority classes for outgoing lines
+INTERACTIVE = 0     # replies to someone
+BROADCAST = 1       # everything else, such as announcements from pollers
+
+# the protocol allows 512 bytes per line including the CRLF, and the server
+# prepends our nick!user@host when relaying, so leave room for that
+MAX_LINE = 512
+PREFIX_RESERVE = 100
+# put between lines that were joined into one message
+JOIN_SEPARATOR = ' | '
+
+class RoundRobin(object):
+    """Lines queued per target, taken from one target at a time in turn, so a
+    busy target can't hold up the others. Lines are kept with the time they
+    were queued."""
+    def __init__(self):
+        self.targets = deque()
+        self.lines = {}
+
+    def __len__(self):
+        return len(self.targets)
+
+    def push(self, target, text, queued_at):
+        if not target in self.lines:
+            self.lines[target] = deque()
+            self.targets.append(target)
+        self.lines[target].append((text, queued_at))
+
+    def push_front(self, target, text, queued_at):
+        if not target in self.lines:
+            self.lines[target] = deque()
+            self.targets.appendleft(target)
+        self.lines[target].appendleft((text, queued_at))
+
+    def peek(self):
+        target = self.targets[0]
+        return (target,) + self.lines[target][0]
+
+    def front_ready(self, queued_by):
+        """Moves the first target, in turn order, whose next line was queued
+        by queued_by to the front, leaving the others in order. Returns
+        False if there is none."""
+        for i, target in enumerate(self.targets):
+            if self.lines[target][0][1] <= queued_by:
+                if i:
+                    del self.targets[i]
+                    self.targets.appendleft(target)
+                return True
+        return False
+
+    def oldest_head(self):
+        """When the longest waiting of the targets' next lines was queued"""
+        return min(self.lines[target][0][1] for target in self.targets)
+
+    def join_head(self, join_limit):
+        """Joins the lines after the next one on to it, for as long as the
+        message stays within join_limit bytes. Returns how many lines are now
+        one."""
+        target = self.targets[0]
+        lines = self.lines[target]
+        text, queued_at = lines.popleft()
+        limit = join_limit - len('PRIVMSG %s :\r\n' % (target,))
+        joined = 1
+        while lines and len(text) + len(JOIN_SEPARATOR) + len(lines[0][0]) <= limit:
+            text += JOIN_SEPARATOR + lines.popleft()[0]
+            joined += 1
+        lines.appendleft((text, queued_at))
+        return joined
+
+    def drop_oldest(self):
+        """Throws away the line that has been waiting longest"""
+        target = min(self.targets, key=lambda t: self.lines[t][0][1])
+        lines = self.lines[target]
+        lines.popleft()
+        if not lines:
+            self.targets.remove(target)
+            del self.lines[target]
+
+    def pop(self):
+        target = self.targets.popleft()
+        lines = self.lines[target]
+        text = lines.popleft()[0]
+        if lines:
+            self.targets.append(target)
+        else:
+            del self.lines[target]
+        return target, text
+
+class OutboundQueue(object):
+    """Lines waiting to go out to the server. Any thread may push lines, and
+    the plugin's thread sends them as fast as the limits allow: at most
+    messages lines, and if given at most bytes bytes of protocol traffic,
+    per window seconds, with bursts up to those amounts.
+
+    Each priority class takes turns between targets. While both classes have
+    lines waiting, up to interactive_weight interactive lines go out for
+    every broadcast line.
+
+    With a coalesce_window, a line waits that many seconds for more lines to
+    the same target, and consecutive lines are then joined into as few
+    messages as fit in an IRC line. Lines are byte strings, so the limit is
+    in encoded bytes.
+
+    At most max_lines lines are held, which matters while the server is
+    unreachable. Past that the oldest broadcast lines are thrown away first,
+    then the oldest replies, and each one is counted in stats as
+    irc_buffer_dropped.
+
+    After hand_over(), lines pushed to the queue go straight on to another
+    one instead.
+
+    """
+    def __init__(self, messages, window, bytes=None, interactive_weight=4, coalesce_window=None,
+            max_lines=None, stats=None):
+        self.lock = threading.Lock()
+        self.classes = (RoundRobin(), RoundRobin())
+        self.interactive_weight = interactive_weight
+        self.coalesce_window = coalesce_window
+        self.max_lines = max_lines
+        self.stats = stats
+        self.size = 0
+        # set by hand_over(), takes (target, text, priority) for lines pushed
+        # to us from then on
+        self.forward = None
+        # interactive lines sent since the last broadcast line
+        self._credit = 0
+        self.message_bucket = TokenBucket(messages, messages / float(window))
+        if bytes:
+            self.byte_bucket = TokenBucket(bytes, bytes / float(window))
+        else:
+            self.byte_bucket = None
+
+    def __len__(self):
+        return self.size
+
+    def push(self, target, text, priority):
+        with self.lock:
+            if self.forward is not None:
+                self.forward(target, text, priority)
+                return
+            self.classes[priority].push(target, text, time.time())
+            self.size += 1
+            self._trim()
+
+    def requeue(self, lines):
+        """Puts lines that could not be sent back at the front"""
+        with self.lock:
+            if self.forward is not None:
+                for target, text, priority in lines:
+                    self.forward(target, text, priority)
+                return
+            for target, text, priority in reversed(lines):
+                # they have waited long enough already
+                self.classes[priority].push_front(target, text, 0)
+            self.size += len(lines)
+            self._trim()
+
+    def hand_over(self, forward):
+        """Passes the lines waiting here to forward(target, text, priority),
+        and from now on every line pushed to us as well. No line can slip in
+        between, since both happen under the lock."""
+        with self.lock:
+            self.forward = forward
+            for priority, queue in enumerate(self.classes):
+                while queue:
+                    target, text = queue.pop()
+                    forward(target, text, priority)
+            self.size = 0
+
+    def _trim(self):
+        if self.max_lines is None:
+            return
+        while self.size > self.max_lines:
+            if self.classes[BROADCAST]:
+                self.classes[BROADCAST].drop_oldest()
+            elif self.classes[INTERACTIVE]:
+                self.classes[INTERACTIVE].drop_oldest()
+            else:
+                self.size = 0
+                break
+            self.size -= 1
+            if self.stats is not None:
+                self.stats.count('irc_buffer_dropped')
+
+    def _next_class(self):
+        interactive, broadcast = self.classes
+        if not broadcast:
+            return INTERACTIVE
+        if not interactive or self._credit >= self.interactive_weight:
+            return BROADCAST
+        return INTERACTIVE
+
+    def take_sendable(self, now):
+        """Returns the (target, text, priority) lines that may be sent now, and
+        how many seconds until the next one may be sent, or None if there are
+        no more"""
+        sendable = []
+        with self.lock:
+            while self.classes[INTERACTIVE] or self.classes[BROADCAST]:
+                priority = self._next_class()
+                queue = self.classes[priority]
+                if self.coalesce_window is not None:
+                    # give the rest of a multi-line reply time to arrive, but
+                    # meanwhile send lines that already have to other targets
+                    queued_by = now - self.coalesce_window
+                    if not queue.front_ready(queued_by):
+                        priority = 1 - priority
+                        queue = self.classes[priority]
+                        if not queue or not queue.front_ready(queued_by):
+                            oldest = min(q.oldest_head() for q in self.classes if q)
+                            return sendable, oldest + self.coalesce_window - now
+                    # a joined line counts once, like any other
+                    self.size -= queue.join_head(MAX_LINE - PREFIX_RESERVE) - 1
+                target, text, queued_at = queue.peek()
+                size = len('PRIVMSG %s :%s\r\n' % (target, text))
+                delay = self.message_bucket.delay(1, now)
+                if self.byte_bucket is not None:
+                    delay = max(delay, self.byte_bucket.delay(size, now))
+                if delay > 0:
+                    return sendable, delay
+                self.message_bucket.take(1, now)
+                if self.byte_bucket is not None:
+                    self.byte_bucket.take(size, now)
+                if priority == INTERACTIVE:
+                    self._credit += 1
+                else:
+                    self._credit = 0
+                target, text = queue.pop()
+                self.size -= 1
+                sendable.append((target, text, priority))
+        return sendable, None
+
+def scheduled_delay(reactor, fallback):
+    """Returns how many seconds until the reactor's next scheduled command is
+    due, None if it has none, or fallback if this version of the irc library
+    keeps them somewhere we don't know to look"""
+    commands = getattr(reactor, 'delayed_commands', None)
+    if commands is None:
+        # newer versions have a scheduler object instead
+        commands = getattr(getattr(reactor, 'scheduler', None), 'queue', None)
+    if commands is None:
+        return fallback
+    if not commands:
+        return None
+    # commands are datetimes, aware or not depending on the version
+    due = min(commands)
+    return max(0.0, (due - datetime.datetime.now(due.tzinfo)).total_seconds())
+
+def parse_map(el, tag, attr):
+    """Reads a channelmap or nickmap element into a dict from hesperus channel
+    to the list of IRC channels or nicks mapped to it"""
+    result = {}
+    if el is None:
+        el = []
+    for subel in el:
+        if not subel.tag.lower() == tag:
+            raise ConfigurationError('%smap must contain %s tags' % (tag, tag))
+        channel = subel.get(attr, None)
+        irc_name = subel.text
+        if not channel or not irc_name:
+            raise ConfigurationError('invalid %s tag' % (tag,))
+
+        if not channel in result:
+            result[channel] = [irc_name]
         else:
-            # received this message within the last waittime seconds of lastmsg
-            self.msgcount += 1
+            result[channel].append(irc_name)
+    return result
 
-            if self.msgcount >= 5:
-                time.sleep(self.waittime)
-                self.lastmsg = now + self.waittime
+def reverse_map(mapping):
+    """From irc.strings.lower() of each IRC channel or nick in a map from
+    parse_map() to the hesperus channels it maps to"""
+    routes = {}
+    for k in mapping:
+        for irc_name in mapping[k]:
+            chans = routes.setdefault(irc.strings.lower(irc_name), [])
+            if not k in chans:
+                chans.append(k)
+    return routes
 
 class IRCPluginBot(IRCBot):
-    def __init__(self, plugin, channels):
-        IRCBot.__init__(self, [(plugin.server, plugin.port)], plugin.nick, plugin.nick)
-        self.initial_channels = channels
+    """The connection to one IRC server, along with the channel maps and
+    outbound queue that go with it"""
+    def __init__(self, plugin, name, host, port, nick, nickserv_password, chanmap, nickmap, outbound,
+            reconnect_min=2.0, reconnect_max=300.0):
+        IRCBot.__init__(self, [(host, port)], nick, nick)
         self.plugin = plugin
-        self.ratelimit = RateLimit()
+        self.name = name
+        self.host = host
+        self.port = port
+        self.nickserv_password = nickserv_password
+        self.chanmap = chanmap
+        self.nickmap = nickmap
+        self.outbound = outbound
+        self.connected = False
+
+        # reconnecting: failed attempts so far, when the next one is due and
+        # when we lost the connection, for the time-to-recover stats
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.reconnect_attempts = 0
+        self.reconnect_at = None
+        self.disconnected_at = None
+
+        self.initial_channels = []
+        for k in self.chanmap:
+            for chan in self.chanmap[k]:
+                if not chan in self.initial_channels:
+                    self.initial_channels.append(chan)
+
+        # the reverse of chanmap and nickmap, from irc.strings.lower() of an
+        # IRC channel or nick to the hesperus channels it maps to
+        self.channel_routes = reverse_map(self.chanmap)
+        self.nick_routes = reverse_map(self.nickmap)
+
+        # irc.strings.lower(nick) -> set of the IRC channels we share with
+        # them, kept up to date from membership events so we don't have to
+        # ask every channel whether it has a user
+        self.nick_channels = {}
+
+    def route(self, irc_channels, irc_nick):
+        """Returns the hesperus channels for a message from irc_nick in the
+        given IRC channels"""
+        chans = []
+        for irc_channel in irc_channels:
+            for k in self.channel_routes.get(irc.strings.lower(irc_channel), ()):
+                if not k in chans:
+                    chans.append(k)
+        for k in self.nick_routes.get(irc.strings.lower(irc_nick), ()):
+            if not k in chans:
+                chans.append(k)
+        return chans
+
+    def send_outgoing(self, chan, msg):
+        if chan in self.chanmap:
+            for irc_chan in self.chanmap[chan]:
+                self.send_privmsg(irc_chan, msg, BROADCAST)
+        if chan in self.nickmap:
+            for irc_nick in self.nickmap[chan]:
+                self.send_privmsg(irc_nick, msg, BROADCAST)
+
+    def send_privmsg(self, target, text, priority=INTERACTIVE):
+        """Queues a message to an IRC channel or nick and returns right away.
+        Safe to call from any thread. priority is INTERACTIVE or BROADCAST.
+        Unicode is sent as UTF-8. After hand_over() the line goes to the bot
+        that replaced us."""
+        # the outbound queue measures lines in bytes, so it only takes bytes;
+        # the irc library hands us channel names as unicode
+        if isinstance(target, unicode):
+            target = target.encode('utf-8')
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self.outbound.push(target, text, priority)
+        self.plugin.wake()
+
+    def flush_outbound(self):
+        """Sends whatever the rate limits allow, and returns how many seconds
+        until the next line may be sent, or None if there is nothing to send
+        yet"""
+        if not self.connected:
+            return None
+        lines, delay = self.outbound.take_sendable(time.time())
+        for i, (target, text, priority) in enumerate(lines):
+            try:
+                self.connection.privmsg(target, text)
+            except ServerNotConnectedError:
+                self.outbound.requeue(lines[i:])
+                return None
+            except Exception:
+                # one bad line mustn't take the whole connection down with it
+                self.plugin.log_warning("dropping line to", repr(target), repr(text))
+                self.plugin.log_warning(traceback.format_exc())
+        return delay
+
+    def keep_connected(self, now):
+        """Connects again if we have lost the server, backing off
+        exponentially between failed attempts, with jitter so several bots
+        don't all come back at once. This is the only way we reconnect, see
+        _on_disconnect(). Returns how many seconds until the next
+        attempt, or None if we are connected."""
+        if self.connection.is_connected():
+            return None
+        if self.reconnect_at is None:
+            backoff = min(self.reconnect_max, self.reconnect_min * 2 ** self.reconnect_attempts)
+            self.reconnect_at = now + backoff * random.uniform(0.5, 1.0)
+        if now < self.reconnect_at:
+            return self.reconnect_at - now
+        self.reconnect_at = None
+        self.reconnect_attempts += 1
+        self.plugin.log_verbose("reconnecting to", self.host, "attempt", self.reconnect_attempts)
+        self._connect()
+        if self.connection.is_connected():
+            # registered or not, wait for the server's welcome
+            return None
+        return self.keep_connected(now)
+
+    def hand_over(self, successor):
+        """Passes everything still waiting to be sent, and everything sent to
+        us from now on, to the bot that replaced us on reload"""
+        self.outbound.hand_over(successor.send_privmsg)
+
+    def _add_member(self, nick, channel):
+        self.nick_channels.setdefault(irc.strings.lower(nick), set()).add(channel)
+
+    def _remove_member(self, nick, channel):
+        nick = irc.strings.lower(nick)
+        channels = self.nick_channels.get(nick)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self.nick_channels[nick]
+
+    def _forget_channel(self, channel):
+        for nick in list(self.nick_channels):
+            self._remove_member(nick, channel)
+
+    def on_join(self, c, e):
+        self._add_member(e.source.nick, e.target)
+
+    def on_namreply(self, c, e):
+        # arguments are the channel type, the channel and the names, each
+        # possibly prefixed with a mode character
+        channel = e.arguments[1]
+        for nick in e.arguments[2].split():
+            self._add_member(nick.lstrip('@+%&~'), channel)
+
+    def on_part(self, c, e):
+        if e.source.nick == c.get_nickname():
+            self._forget_channel(e.target)
+        else:
+            self._remove_member(e.source.nick, e.target)
+
+    def on_kick(self, c, e):
+        if e.arguments[0] == c.get_nickname():
+            self._forget_channel(e.target)
+        else:
+            self._remove_member(e.arguments[0], e.target)
+
+    def on_quit(self, c, e):
+        self.nick_channels.pop(irc.strings.lower(e.source.nick), None)
+
+    def on_nick(self, c, e):
+        channels = self.nick_channels.pop(irc.strings.lower(e.source.nick), None)
+        if channels:
+            self.nick_channels.setdefault(irc.strings.lower(e.target), set()).update(channels)
+
+    def on_all_raw_messages(self, c, e):
+        capture = self.plugin.capture
+        if capture is not None:
+            capture.write("%.3f %s %s\n" % (time.time(), self.name, e.arguments[0].encode('utf-8')))
+
+    def _on_disconnect(self, c, e):
+        # replaces SingleServerIRCBot's handler, which would also schedule a
+        # reconnect of its own; keep_connected() is the only one we want
+        self.channels.clear()
+
+    def on_disconnect(self, c, e):
+        # lines stay in the outbound queue until we are welcomed back
+        self.connected = False
+        self.nick_channels.clear()
+        if self.disconnected_at is None:
+            self.disconnected_at = time.time()
+            self.plugin.log_warning("lost connection to", self.host)
     
     def on_nicknameinuse(self, c, e):
         c.nick(c.get_nickname() + "_")
     
     def on_welcome(self, c, e):
-        self.plugin.log_message("connected to", self.plugin.server)
-        if self.plugin.nickserv_password:
+        self.plugin.log_message("connected to", self.host)
+        if self.nickserv_password:
             self.plugin.log_verbose("sending password to NickServ...")
-            self.connection.privmsg("NickServ", "identify " + self.plugin.nickserv_password)
+            self.connection.privmsg("NickServ", "identify " + self.nickserv_password)
         for chan in self.initial_channels:
             c.join(chan)
-        self.plugin.connected = True
+        self.connected = True
+        self.reconnect_attempts = 0
+        self.reconnect_at = None
+        if self.disconnected_at is not None:
+            recovery = time.time() - self.disconnected_at
+            self.disconnected_at = None
+            self.plugin.stats.record('irc_recovery', recovery)
+            self.plugin.stats.count('irc_reconnects')
+            self.plugin.log_message("back on", self.host, "after %.1f seconds," % (recovery,),
+                len(self.outbound), "lines to catch up on")
     
     def strip_nonprintable(self, s):
         return filter(lambda c: c in string.printable, s)
@@ -61,29 +534,25 @@ class IRCPluginBot(IRCBot):
         msg = e.arguments[0].strip()
         msg = self.strip_nonprintable(msg)
         def reply(msg):
-            self.ratelimit.call()
-            self.connection.privmsg(channel, msg.encode('utf-8'))
-        self.plugin.do_input([channel], e.source.nick, msg, False, reply)
+            self.send_privmsg(channel, msg.encode('utf-8'), INTERACTIVE)
+        self.plugin.do_input(self, [channel], e.source.nick, msg, False, reply)
     
     def do_command(self, source, channel, cmd):
         if cmd == "":
             return
         
         def reply(msg):
-            self.ratelimit.call()
             if channel == None:
-                self.connection.privmsg(source, msg.encode('utf-8'))
+                self.send_privmsg(source, msg.encode('utf-8'), INTERACTIVE)
             else:
-                self.connection.privmsg(channel, ("%s: %s" % (source, msg)).encode('utf-8'))
+                self.send_privmsg(channel, ("%s: %s" % (source, msg)).encode('utf-8'), INTERACTIVE)
         
         channels = []
         if channel != None:
             channels.append(channel)
         else:
-            for chan in self.channels:
-                if self.channels[chan].has_user(source):
-                    channels.append(chan)
-        self.plugin.do_input(channels, source, cmd, True, reply)
+            channels.extend(self.nick_channels.get(irc.strings.lower(source), ()))
+        self.plugin.do_input(self, channels, source, cmd, True, reply)
 
 class IRCPlugin(Plugin):
     """The IRC plugin. This listens for messages on the configured IRC channels
@@ -101,49 +570,122 @@ class IRCPlugin(Plugin):
     to everyone, and plugins that respond to "admin" and will get messages only
     from admins.
 
+    One plugin can connect to several networks at once from a single thread.
+    Instead of the server, port, channelmap and nickmap settings, give a
+    servers element with a server element for each network:
+
+        <servers>
+          <server name="freenode" host="chat.freenode.net" port="6667">
+            <channelmap>...</channelmap>
+            <nickmap>...</nickmap>
+          </server>
+        </servers>
+
+    A server element may also have nick and nickserv-password attributes,
+    which default to the plugin's settings. Messages on a hesperus channel go
+    out to every network that maps it.
+
+    Replies and outgoing messages never block: they are queued and sent from
+    the plugin's own thread, paced by token buckets so the server doesn't
+    kick us for flooding. rate_messages lines, and rate_bytes bytes if set,
+    may be sent per rate_window seconds. Each server has limits of its own.
+
+    Each IRC channel and nick gets its own queue and they take turns, so a
+    flood of lines to one channel doesn't delay replies in another. Replies
+    also take priority over messages from send_outgoing(), such as feed
+    announcements: up to interactive_weight replies go out for each of
+    those.
+
+    If coalesce_lines is set, a line waits up to coalesce_window seconds for
+    more lines to the same place, and lines that arrive back to back are
+    sent as one message, joined with " | ", as far as they fit in an IRC
+    line. Plugins that reply with many short lines then use up far fewer of
+    the rate limit's messages.
+
+    If a server connection drops, we try again after reconnect_min seconds,
+    doubling the wait after each failure up to reconnect_max, and join our
+    channels again once back. Lines sent in the meantime are held, up to
+    outbound_buffer per server, and go out under the usual rate limits after
+    reconnecting. The stats command shows how long recovery took as
+    irc_recovery.
+
+    With capture_file set, every line the servers send us is appended to
+    that file as it arrives, as
+
+        <unix time> <server name> <raw line>
+
+    ircreplay.py can then play the capture back to the bot at whatever speed,
+    standing in for the server.
+
     """
+    # the reactor loop must keep running, so don't share a pool worker
+    dedicated_thread = True
+    # our thread sleeps until a server sends something, we queue a line, a
+    # queued call arrives or a reactor has a scheduled job due; if we can't
+    # see when those are due, it wakes up this often to run them
+    reactor_tick = 1.0
 
-    @Plugin.config_types(server=str, port=int, nick=str, nickserv_password=str, channelmap=ET.Element, nickmap=ET.Element, quitmsgs=ET.Element)
-    def __init__(self, core, server='chat.freenode.net', port=6667, nick='hesperus', nickserv_password=None, channelmap=None, nickmap=None, quitmsgs=None):
+    @Plugin.config_types(server=str, port=int, nick=str, nickserv_password=str, channelmap=ET.Element, nickmap=ET.Element, quitmsgs=ET.Element,
+            servers=ET.Element, rate_messages=int, rate_window=float, rate_bytes=int, interactive_weight=int,
+            coalesce_lines=bool, coalesce_window=float, reconnect_min=float, reconnect_max=float, outbound_buffer=int,
+            capture_file=str)
+    def __init__(self, core, server='chat.freenode.net', port=6667, nick='hesperus', nickserv_password=None, channelmap=None, nickmap=None, quitmsgs=None,
+            servers=None, rate_messages=5, rate_window=2.0, rate_bytes=2048, interactive_weight=4,
+            coalesce_lines=False, coalesce_window=0.1, reconnect_min=2.0, reconnect_max=300.0, outbound_buffer=200,
+            capture_file=None):
         
         super(IRCPlugin, self).__init__(core)
-        
-        self.server = server
-        self.port = port
+
+        if rate_messages < 1 or rate_window <= 0 or rate_bytes < 0:
+            raise ConfigurationError('rate limits must be positive')
+        if interactive_weight < 1:
+            raise ConfigurationError('interactive_weight must be at least 1')
+        if coalesce_window < 0:
+            raise ConfigurationError('coalesce_window must not be negative')
+        if reconnect_min <= 0 or reconnect_max < reconnect_min:
+            raise ConfigurationError('reconnect_min must be positive and no more than reconnect_max')
+        if outbound_buffer < 1:
+            raise ConfigurationError('outbound_buffer must be at least 1')
+        def make_outbound():
+            return OutboundQueue(rate_messages, rate_window, rate_bytes, interactive_weight,
+                    coalesce_window if coalesce_lines else None, outbound_buffer, self.stats)
+
         self.nick = nick
-        self.nickserv_password = nickserv_password
-        self.chanmap = {}
-        self.nickmap = {}
-        
-        if channelmap == None:
-            channelmap = []
-        for el in channelmap:
-            if not el.tag.lower() == 'channel':
-                raise ConfigurationError('channelmap must contain channel tags')
-            channel = el.get('name', None)
-            irc_channel = el.text
-            if not channel or not irc_channel:
-                raise ConfigurationError('invalid channel tag')
-            
-            if not channel in self.chanmap:
-                self.chanmap[channel] = [irc_channel]
-            else:
-                self.chanmap[channel].append(irc_channel)
-        
-        if nickmap == None:
-            nickmap = []
-        for el in nickmap:
-            if not el.tag.lower() == 'nick':
-                raise ConfigurationError('nickmap must contain nick tags')
-            channel = el.get('channel', None)
-            irc_nick = el.text
-            if not channel or not irc_nick:
-                raise ConfigurationError('invalid nick tag')
-            
-            if not channel in self.nickmap:
-                self.nickmap[channel] = [irc_nick]
-            else:
-                self.nickmap[channel].append(irc_nick)
+        self.capture_file = capture_file
+        # opened by run(), so a reload doesn't start a new file
+        self.capture = None
+        self.bots = []
+        if servers is None:
+            self.bots.append(IRCPluginBot(self, server, server, port, nick, nickserv_password,
+                parse_map(channelmap, 'channel', 'name'), parse_map(nickmap, 'nick', 'channel'),
+                make_outbound(), reconnect_min, reconnect_max))
+        else:
+            if channelmap is not None or nickmap is not None:
+                raise ConfigurationError('channelmap and nickmap go inside each server when using servers')
+            for el in servers:
+                if not el.tag.lower() == 'server':
+                    raise ConfigurationError('servers must contain server tags')
+                host = el.get('host', None)
+                if not host:
+                    raise ConfigurationError('server tags need a host')
+                if ' ' in el.get('name', ''):
+                    raise ConfigurationError('server names must not contain spaces')
+                try:
+                    server_port = int(el.get('port', 6667))
+                except ValueError:
+                    raise ConfigurationError('server port must be an integer')
+                name = el.get('name', host)
+                if name in [bot.name for bot in self.bots]:
+                    raise ConfigurationError('server name "%s" is used twice' % (name,))
+                self.bots.append(IRCPluginBot(self, name, host, server_port,
+                    el.get('nick', nick), el.get('nickserv-password', nickserv_password),
+                    parse_map(el.find('channelmap'), 'channel', 'name'),
+                    parse_map(el.find('nickmap'), 'nick', 'channel'),
+                    make_outbound(), reconnect_min, reconnect_max))
+            if not self.bots:
+                raise ConfigurationError('servers must contain at least one server')
+        # the first server's bot, for code that only knows about one
+        self.bot = self.bots[0]
 
         if quitmsgs is None or len(quitmsgs) is 0:
             self.quitmsg = 'Daisy, daisy...'
@@ -151,64 +693,73 @@ class IRCPlugin(Plugin):
             self.quitmsg = filter(lambda el: el.tag.lower() == 'quitmsg',
                 quitmsgs)[int(time.time()) % len(quitmsgs)].text
         
-        channels = []
-        for k in self.chanmap:
-            self.subscribe(k)
-            for chan in self.chanmap[k]:
-                if not chan in channels:
-                    channels.append(chan)
-        for k in self.nickmap:
-            self.subscribe(k)
-        
-        self.bot = IRCPluginBot(self, channels)
+        for bot in self.bots:
+            for k in bot.chanmap:
+                self.subscribe(k)
+            for k in bot.nickmap:
+                self.subscribe(k)
 
     @property
     def connected(self):
-        with self.lock:
-            return getattr(self, "_connected", False)
-    @connected.setter
-    def connected(self, value):
-        with self.lock:
-            self._connected = value
+        """True once every server has welcomed us"""
+        return all(bot.connected for bot in self.bots)
         
     def run(self):
+        if self.capture_file:
+            # line buffered, so lines are on disk as they arrive and a crash
+            # doesn't lose the end of the capture
+            self.capture = open(self.capture_file, 'a', 1)
         self.log_verbose("connecting...")
         # start() calls _connect() and then reactor.process_forever()... since
         # we want to be in control of the main loop, just call _connect() for
         # now.
-        #self.bot.start()
-        self.bot._connect()
+        for bot in self.bots:
+            bot._connect()
         try:
             while True:
-                self.bot.reactor.process_once()
-                yield
+                delay = None
+                for bot in self.bots:
+                    # wait_fds() means we usually get here because data arrived
+                    bot.reactor.process_once(0)
+                    for bot_delay in (bot.keep_connected(time.time()), bot.flush_outbound(),
+                            scheduled_delay(bot.reactor, self.reactor_tick)):
+                        if bot_delay is not None and (delay is None or bot_delay < delay):
+                            delay = bot_delay
+                if self._pool is not None:
+                    # on the worker pool nobody watches our sockets
+                    delay = self.idle_wait if delay is None else min(delay, self.idle_wait)
+                yield self.FOREVER if delay is None else delay
         finally:
             # Apparently, IRC servers only use your quit message if you've been
             # connected for more than 5 minutes (according to a comment in
             # irclib). No idea why.
-            self.bot.disconnect(self.quitmsg)
+            for bot in self.bots:
+                bot.disconnect(self.quitmsg)
+            if self.capture is not None:
+                self.capture.close()
+                self.capture = None
+
+    def wait_fds(self):
+        fds = []
+        for bot in self.bots:
+            fds.extend(bot.reactor.sockets)
+        return fds
     
     @Plugin.queued
-    def do_input(self, irc_channels, irc_nick, msg, direct, reply):
-        chans = []
-        for irc_channel in irc_channels:
-            for k in self.chanmap:
-                if irc_channel in self.chanmap[k] and not k in chans:
-                    chans.append(k)
-        for k in self.nickmap:
-            if irc_nick in self.nickmap[k] and not k in chans:
-                chans.append(k)
-        
+    def do_input(self, bot, irc_channels, irc_nick, msg, direct, reply):
+        chans = bot.route(irc_channels, irc_nick)
         self.parent.handle_incoming(chans, irc_nick, msg, direct, reply)
     
-    @Plugin.queued
     def send_outgoing(self, chan, msg):
         msg = msg.encode('UTF-8')
-        if chan in self.chanmap:
-            for irc_chan in self.chanmap[chan]:
-                self.bot.ratelimit.call()
-                self.bot.connection.privmsg(irc_chan, msg)
-        if chan in self.nickmap:
-            for irc_nick in self.nickmap[chan]:
-                self.bot.ratelimit.call()
-                self.bot.connection.privmsg(irc_nick, msg)
+        for bot in self.bots:
+            bot.send_outgoing(chan, msg)
+
+    def hand_over(self, successor):
+        """Has each of our servers pass everything still waiting to be sent,
+        and everything sent to it from now on, to the same server in the
+        plugin that replaced us on reload. Replies to messages that came in
+        through us keep working this way."""
+        new_bots = dict((bot.name, bot) for bot in successor.bots)
+        for bot in self.bots:
+            bot.hand_over(new_bots.get(bot.name, successor.bots[0]))
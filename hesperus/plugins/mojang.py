@@ -41,8 +41,8 @@ class MojangStatus(PollPlugin):
     
     def _get_current_status(self):
         try:
-            status_json = json.loads(requests.get(self.STATUS_URL).text)
-        except (requests.exceptions.ConnectionError, ValueError) as err:
+            status_json = json.loads(self.http.get(self.STATUS_URL).text)
+        except (requests.exceptions.RequestException, ValueError) as err:
             self.log_warning(err)
             return None
         return dict((server, status) for e in status_json for (server, status) in e.iteritems())
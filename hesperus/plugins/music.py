@@ -1,6 +1,5 @@
 from ..plugin import CommandPlugin
 
-import requests
 try:
     from bs4 import BeautifulSoup
 except ImportError:
@@ -21,7 +20,7 @@ class IcecastStatus(CommandPlugin):
                 song=self._remove_unicode(stream['Current Song']) if stream['Current Song'] else 'UNKNOWN'))
 
     def _get_status(self):
-        page = BeautifulSoup(requests.get(self._url).content)
+        page = BeautifulSoup(self.http.get(self._url).content)
         streams = []
         for div in page.findAll('div', attrs={'class': 'streamheader'}):
             table = div.nextSibling.nextSibling
@@ -1,5 +1,4 @@
 from ..plugin import CommandPlugin
-import requests
 import re
 
 try:
@@ -16,7 +15,7 @@ class PlanetSideStatus(CommandPlugin):
             pattern = re.compile(match.group(1), re.I)
         else:
             pattern = re.compile('Mattherson', re.I)
-        data = BeautifulSoup(requests.get(self.STATUS_URL).text)
+        data = BeautifulSoup(self.http.get(self.STATUS_URL).text)
         servers = dict((s[0].string, s[1].string) \
                 for s in (tr.find_all('td') for tr in data.table.tbody.find_all('tr')))
         reply('PS2 Server Status: ' + ', '.join('%s => %s' % (sn, st) \
@@ -5,7 +5,6 @@ from hesperus.core import ConfigurationError, ET
 import time
 import random
 import json
-import requests
 import re
 
 class RedditPlugin(CommandPlugin):
@@ -55,7 +54,7 @@ class RedditPlugin(CommandPlugin):
         url = self.MAINURL.format(name=name, count=self.count)
         self.log_debug('fetching {0}'.format(url))
         try:
-            results = json.loads(requests.get(url, headers={'User-Agent': self.USERAGENT}).content)
+            results = json.loads(self.http.get(url, headers={'User-Agent': self.USERAGENT}).content)
             results = results['data']['children']
         except Exception:
             # bad result!
@@ -1,4 +1,3 @@
-import time
 import traceback
 import random
 
@@ -6,6 +5,9 @@ from ..plugin import CommandPlugin, Plugin
 from ..core import ConfigurationError, ET
 
 class Reloader(CommandPlugin):
+    # reloading waits for the old plugin to stop, which mustn't hold up a
+    # pool worker the old plugin might need to get there
+    dedicated_thread = True
 
     def __init__(self, core, skip=None):
         """Initialize the reloader plugin.
@@ -139,21 +141,12 @@ class Reloader(CommandPlugin):
 
 
         if ircplugin and oldircplugin:
-            # We have reloaded the ircplugin. We cannot use the given reply()
-            # method because that connection to the server has been severed.
-            # XXX Terrible hack incomming!!! Warning!
-            # The old IRCPlugin object is still hanging around in memory.  We
-            # cannot edit the reply() method or even know what it does, but we
-            # CAN replace the connection object in the old IRCPlugin object
-            # with the new one.
-            # If we survive the rest of this method, we should be okay since
-            # the old IRCPlugin object should be garbage collected very soon.
-            self.log_debug("Waiting for IRC to re-connect")
-            while not ircplugin.connected:
-                time.sleep(0.5)
-            oldircplugin.bot.connection = ircplugin.bot.connection
-            self.log_debug("IRC connected. Swapping connection object and proceeding to reply...")
-            time.sleep(1)
+            # We have reloaded the ircplugin. The reply() method we were given
+            # queues messages on the old IRCPlugin, whose connection has been
+            # severed, so have it forward them to the new one. They go out as
+            # soon as the new plugin has connected.
+            self.log_debug("Handing the old IRC plugin's messages over to the new one")
+            oldircplugin.hand_over(ircplugin)
 
         if match.group(1) and not foundunload and not foundreload:
             # A specific plugin was requested but it was neither unloaded or
@@ -2,15 +2,17 @@ import time
 from HTMLParser import HTMLParser
 
 import feedparser
+import requests
 
 from ..plugin import PollPlugin
-from ..shorturl import short_url
+from ..shorturl import short_urls
 from ..core import ET, ConfigurationError
 
 class Feed(object):
-    def __init__(self, url, formatstr):
+    def __init__(self, url, formatstr, http):
         self.url = url
         self.formatstr = formatstr
+        self.http = http
 
         # Go ahead and fetch the feed so we can see what entries are already there
         feedobj = self._fetch()
@@ -19,12 +21,21 @@ class Feed(object):
                 )
 
     def _fetch(self):
-        feedobj = feedparser.parse(self.url)
+        # fetch it through the plugin's HTTP client rather than letting
+        # feedparser do it, so a server that stops answering times out
+        try:
+            response = self.http.get(self.url)
+            response.raise_for_status()
+        except requests.RequestException as err:
+            # what feedparser gives back when it can't get the feed
+            return feedparser.FeedParserDict(feed=feedparser.FeedParserDict(), entries=[],
+                    bozo=1, bozo_exception=err)
+        feedobj = feedparser.parse(response.content, response_headers=dict(response.headers))
         return feedobj
 
-    def _format_entry(self, feed, entry):
+    def _format_entry(self, feed, entry, short_link):
         #decode htmlentities, then strip out utf-8 chars
-        entry['short_link'] = short_url(entry['link']) if 'link' in entry else short_url(self.url)
+        entry['short_link'] = short_link
         parser = HTMLParser()
         entry = dict(
             (key, value if value.startswith('http') else self._strip_unicode(parser.unescape(value))) \
@@ -41,11 +52,17 @@ class Feed(object):
         """
         feedobj = self._fetch()
 
+        new_entries = []
         for entry in feedobj.entries:
             key = entry.id if hasattr(entry, 'id') else entry.published
             if key not in self.seen_entries:
                 self.seen_entries.add(key)
-                yield self._format_entry(feedobj.feed, entry)
+                new_entries.append(entry)
+
+        # shorten all the links at once rather than one round trip each
+        links = short_urls([entry['link'] if 'link' in entry else self.url for entry in new_entries])
+        for entry, short_link in zip(new_entries, links):
+            yield self._format_entry(feedobj.feed, entry, short_link)
 
     def __str__(self):
         return "<Feed for %s in channels %r>" % (self.url, self.channels)
@@ -112,7 +129,7 @@ class RSSWatcher(PollPlugin):
                     formatstr = el.text
 
             self.feeds.append(
-                    (Feed(url, formatstr), channels)
+                    (Feed(url, formatstr, self.http), channels)
                     )
 
     def poll(self):
@@ -120,7 +137,7 @@ class RSSWatcher(PollPlugin):
             for responsestr in feedobj.get_new_events():
                 for chan in channels:
                     while time.time() < self.last_msg + self.ratelimit:
-                        yield
+                        yield self.last_msg + self.ratelimit - time.time()
                     self.parent.send_outgoing(chan, responsestr)
                     self.last_msg = time.time()
                     yield
@@ -39,7 +39,8 @@ class SeenPlugin(CommandPlugin):
         else:
             reply("%s was last seen %s." % (target, fmtdate(self.times[target])))
     
-    @CommandPlugin.queued
+    # only the latest sighting of each nick matters
+    @CommandPlugin.coalesced()
     def update_seen(self, name):
         self.times[name] = datetime.utcnow()
     
@@ -0,0 +1,85 @@
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import threading
+
+from ..plugin import Plugin
+from .. import shorturl
+
+class RedirectServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class RedirectHandler(BaseHTTPRequestHandler):
+    """Sends /<code> on to the URL it stands for"""
+    def do_GET(self):
+        code = self.path.lstrip('/').split('?', 1)[0]
+        url = self.server.shortener.lookup(code) if code else None
+        if url is None:
+            self.send_response(404)
+            self.send_header('Content-Type', 'text/plain')
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write('Not found\n')
+            return
+        self.send_response(301)
+        self.send_header('Location', url)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        self.server.plugin.log_debug(self.address_string(), format % args)
+
+class ShortenerPlugin(Plugin):
+    """Shortens URLs locally, through the "local" provider in hesperus.shorturl,
+    and serves the redirects from a small HTTP server of its own. No other
+    service is involved, so shortening never waits on the network.
+
+    base-url is where the server can be reached from outside, and the short
+    URLs are base-url followed by the code. The codes are kept in the anydbm
+    file at path. With make-default, the default, plugins that don't ask for
+    a particular provider get local short URLs.
+
+    <plugin type="hesperus.plugins.shortener.ShortenerPlugin">
+        <base-url>http://example.com:8080/</base-url>
+        <port>8080</port>
+    </plugin>
+
+    """
+    @Plugin.config_types(base_url=str, host=str, port=int, path=str, make_default=bool)
+    def __init__(self, core, base_url, host='', port=8080, path='shorturl-local.db', make_default=True):
+        super(ShortenerPlugin, self).__init__(core)
+        self.base_url = base_url
+        self.host = host
+        self.port = port
+        self.path = path
+        self.make_default = make_default
+
+    def run(self):
+        # the db is only opened here, so a reloaded copy of us doesn't open
+        # it while we still have it
+        shortener = shorturl.LocalShortener(self.base_url, self.path)
+        server = RedirectServer((self.host, self.port), RedirectHandler)
+        server.shortener = shortener
+        server.plugin = self
+        thread = threading.Thread(target=server.serve_forever, name='hesperus-shortener')
+        thread.daemon = True
+        thread.start()
+
+        shorturl.local_shortener = shortener
+        previous_provider = shorturl.default_provider
+        if self.make_default:
+            shorturl.default_provider = 'local'
+        self.log_message("serving short URLs for", self.base_url, "on port", self.port)
+        try:
+            while True:
+                yield self.FOREVER
+        finally:
+            if shorturl.local_shortener is shortener:
+                shorturl.local_shortener = None
+            if self.make_default and shorturl.default_provider == 'local':
+                shorturl.default_provider = previous_provider
+            server.shutdown()
+            server.server_close()
+            shortener.close()
@@ -0,0 +1,68 @@
+from ..plugin import CommandPlugin
+from .. import shorturl
+
+def fmt_time(seconds):
+    if seconds < 1:
+        return '%.1fms' % (seconds * 1000,)
+    return '%.1fs' % (seconds,)
+
+class StatsPlugin(CommandPlugin):
+    """Reports where the plugins spend their time, from Core.collect_stats(),
+    and how well the short URL cache is doing with "stats shorturl"."""
+
+    @CommandPlugin.register_command(r"stats(?:\s+(\w+))?")
+    def stats_command(self, chans, name, match, direct, reply):
+        wanted = match.group(1)
+        if wanted and wanted.lower() == 'shorturl':
+            reply(self.shorturl_stats(shorturl.cache.stats()))
+            return
+        found = False
+        for plug_name, stats in self.parent.collect_stats():
+            if wanted and plug_name.lower() != wanted.lower():
+                continue
+            found = True
+            if wanted:
+                reply(self.detailed(plug_name, stats))
+            else:
+                reply(self.brief(plug_name, stats))
+        if wanted and not found:
+            reply("No running plugin named %s found" % (wanted,))
+
+    def brief(self, plug_name, stats):
+        return "%s: %d calls, wait p99 %s, run p99 %s, step p99 %s, queue max %d, %d dropped" % (
+            plug_name,
+            stats['handler']['count'],
+            fmt_time(stats['enqueue_delay']['p99']),
+            fmt_time(stats['handler']['p99']),
+            fmt_time(stats['step']['p99']),
+            stats['queue_high_water'],
+            stats['dropped'],
+        )
+
+    def detailed(self, plug_name, stats):
+        standard = ('enqueue_delay', 'handler', 'step', 'blocked_put')
+        parts = [self.histogram(key, stats[key]) for key in standard]
+        parts.append("queue max %d" % (stats['queue_high_water'],))
+        parts.append("%d dropped, %d coalesced" % (stats['dropped'], stats['coalesced']))
+        # anything the plugin recorded of its own
+        for key in sorted(stats):
+            if key in standard or key in ('queue_high_water', 'dropped', 'coalesced'):
+                continue
+            if isinstance(stats[key], dict):
+                parts.append(self.histogram(key, stats[key]))
+            else:
+                parts.append("%s %d" % (key.replace('_', ' '), stats[key]))
+        return "%s: %s" % (plug_name, ', '.join(parts))
+
+    def shorturl_stats(self, stats):
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        hits = stats['memory_hits'] + stats['disk_hits']
+        return "shorturl: %d lookups, %d memory hits, %d disk hits, %d misses (%.0f%% hit), %d in memory, %s" % (
+            lookups, stats['memory_hits'], stats['disk_hits'], stats['misses'],
+            100.0 * hits / lookups if lookups else 0.0, stats['cached'],
+            self.histogram('fetch', stats['fetch']))
+
+    def histogram(self, key, h):
+        return "%s %d (mean %s, p50 %s, p99 %s, max %s)" % (
+            key.replace('_', ' '), h['count'], fmt_time(h['mean']),
+            fmt_time(h['p50']), fmt_time(h['p99']), fmt_time(h['max']))
@@ -1,7 +1,6 @@
 from ..plugin import PassivePlugin
 from ..shorturl import short_url
 
-import requests
 
 class SteamLinkPlugin(PassivePlugin):
     STOREFRONT_API_ENDPOINT = 'https://store.steampowered.com/api/{api_method}/'
@@ -46,4 +45,4 @@ class SteamLinkPlugin(PassivePlugin):
 
     def _api_request(self, method, **kwargs):
         url = self.STOREFRONT_API_ENDPOINT.format(api_method=method)
-        return requests.get(url, params=kwargs).json()
+        return self.http.get_json(url, params=kwargs)
@@ -4,7 +4,6 @@ from hesperus.shorturl import short_url
 import re
 
 from googlesearch.googlesearch import GoogleSearch
-import requests
 try:
     from bs4 import BeautifulSoup
 except ImportError:
@@ -45,7 +44,7 @@ class TvTropesPlugin(CommandPlugin):
     def get_info(self, subwiki, title):
         url = self.URLFORMAT.format(subwiki, title)
         self.log_debug('fetching url: %s' % (url,))
-        page = BeautifulSoup(requests.get(url).content)
+        page = BeautifulSoup(self.http.get(url).content)
         title = page.title.string.rsplit('-', 1)[0].strip()
         if title.endswith('/ ' + subwiki):
             title = title.rsplit('/', 1)[0].strip()
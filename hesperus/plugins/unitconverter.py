@@ -2,9 +2,9 @@
 from __future__ import division
 import re
 
-from ..plugin import Plugin
+from ..plugin import PassivePlugin
 
-class UnitConverter(Plugin):
+class UnitConverter(PassivePlugin):
     c_re = re.compile(r"""
             # Make sure it's either at the beginning of a word, beginning of the
             # line, or at least not proceeded by an alphanumeric character
@@ -34,8 +34,11 @@ class UnitConverter(Plugin):
             \b # only capture at word boundaries
             """, re.X)
 
-    @Plugin.queued
-    def handle_incoming(self, chans, name, msg, direct, reply):
+    # Anything c_re or f_re can match also matches this, so the core only
+    # hands us lines that might have a temperature in them
+    @PassivePlugin.register_pattern(r"\d[ ]?(?:degrees[ ])?(?:°)?[CF]\b")
+    def convert(self, match, reply):
+        msg = match.string
         c_matches = self.c_re.findall(msg)
         f_matches = self.f_re.findall(msg)
 
@@ -1,6 +1,5 @@
 import sys
 from urllib import urlencode
-from urllib2 import urlopen
 from xml.etree import ElementTree
 import time
 import random
@@ -11,16 +10,15 @@ from hesperus.shorturl import short_url
 alpha_api_url = "http://api.wolframalpha.com/v2/query"
 alpha_web_url = "http://www.wolframalpha.com/input/"
 
-def alpha(s, alpha_app_id):
+def alpha(s, alpha_app_id, http):
     args = {}
     args['appid'] = alpha_app_id
     args['input'] = s
     args['format'] = 'plaintext'
     args['podindex'] = "1,2"
     
-    url = alpha_api_url + "?" + urlencode(args)
     web_url = alpha_web_url + "?" + urlencode({'i' : s})
-    data = ElementTree.parse(urlopen(url)).getroot()
+    data = ElementTree.fromstring(http.get(alpha_api_url, params=args).content)
     
     if data.get('error', 'true').lower() == 'true' or data.get('success', 'false').lower() == 'false':
         return {'success' : False, 'web' : web_url, 'input' : None, 'output' : None}
@@ -61,7 +59,7 @@ class AlphaPlugin(CommandPlugin):
     
     @CommandPlugin.register_command(r"(?:wolframalpha|wa|alpha|=)\s+(.+)")
     def alpha_command(self, chans, name, match, direct, reply):
-        ret = alpha(match.group(1), self.app_id)
+        ret = alpha(match.group(1), self.app_id, self.http)
         if not ret['success']:
             reply('wolfram alpha is confused: %s' % short_url(ret['web']))
             if random.random() < self.confuse_chance:
@@ -0,0 +1,188 @@
+import threading
+import time
+import heapq
+import itertools
+import select
+import errno
+import traceback
+from collections import deque
+
+from agent import Agent, Waker
+
+class Timer(object):
+    """A handle for a callback registered with a Scheduler"""
+    def __init__(self, when, func, args):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+class Scheduler(object):
+    """Runs callbacks at given times from a single timer thread.
+
+    The thread sleeps in select() until the earliest timer is due, so it uses
+    no CPU while nothing is due and fires timers on time. Callbacks run in the
+    timer thread and must return quickly; typically they just wake up an
+    agent or hand work to a WorkerPool.
+
+    """
+    def __init__(self, name='hesperus-scheduler'):
+        self.name = name
+        self._lock = threading.Lock()
+        self._heap = []
+        self._seq = itertools.count()
+        self._cancelled = 0
+        self._waker = Waker()
+        self._thread = None
+        self._running = False
+
+    def call_at(self, when, func, *args):
+        timer = Timer(when, func, args)
+        with self._lock:
+            heapq.heappush(self._heap, (when, next(self._seq), timer))
+            first = self._heap[0][2] is timer
+        if first:
+            # the thread may be sleeping until a later deadline
+            self._waker.wake()
+        return timer
+
+    def call_later(self, delay, func, *args):
+        return self.call_at(time.time() + delay, func, *args)
+
+    def cancel(self, timer):
+        with self._lock:
+            if timer.cancelled:
+                return
+            timer.cancelled = True
+            self._cancelled += 1
+            # cancelled timers are left in the heap until they come due,
+            # unless they start to make up most of it
+            if self._cancelled > 64 and self._cancelled * 2 > len(self._heap):
+                self._heap = [e for e in self._heap if not e[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+        self._waker.wake()
+
+    def _run(self):
+        while self._running:
+            now = time.time()
+            due = []
+            with self._lock:
+                while self._heap and self._heap[0][0] <= now:
+                    timer = heapq.heappop(self._heap)[2]
+                    if timer.cancelled:
+                        self._cancelled -= 1
+                    else:
+                        due.append(timer)
+                timeout = self._heap[0][0] - now if self._heap else None
+
+            for timer in due:
+                try:
+                    timer.func(*timer.args)
+                except Exception:
+                    traceback.print_exc()
+            if due:
+                continue
+
+            try:
+                select.select([self._waker], [], [], timeout)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+            self._waker.drain()
+
+class WorkerPool(object):
+    """Runs agents that were started with Agent.start_pooled() on a bounded
+    number of worker threads.
+
+    An agent is either idle, waiting in the ready queue, or being stepped by
+    exactly one worker. Waking an agent that is being stepped marks it to run
+    again as soon as the current step is done, so an agent's queued calls and
+    run() steps never overlap. Agents that yield a delay are put back in the
+    ready queue by the scheduler when the delay is up.
+
+    A step that blocks ties up its worker for as long as it blocks, so agents
+    that block for a long time, such as the IRC plugin's socket loop, should
+    keep a thread of their own.
+
+    """
+    def __init__(self, size, scheduler):
+        self.size = size
+        self.scheduler = scheduler
+        self._cond = threading.Condition(threading.Lock())
+        self._ready = deque()
+        self._pending = set()
+        self._busy = set()
+        self._again = set()
+        self._timers = {}
+        self._workers = []
+        self._running = False
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        for i in range(self.size):
+            worker = threading.Thread(target=self._work, name='hesperus-worker-%d' % (i,))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._workers = []
+
+    def submit(self, agent):
+        """Ask for agent to be stepped as soon as a worker is free"""
+        with self._cond:
+            if agent in self._busy:
+                self._again.add(agent)
+            elif not agent in self._pending:
+                self._pending.add(agent)
+                self._ready.append(agent)
+                self._cond.notify()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while self._running and not self._ready:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                agent = self._ready.popleft()
+                self._pending.discard(agent)
+                self._busy.add(agent)
+                timer = self._timers.pop(agent, None)
+            if timer is not None:
+                self.scheduler.cancel(timer)
+
+            delay = agent._pool_step()
+
+            with self._cond:
+                self._busy.discard(agent)
+                if delay is None:
+                    self._again.discard(agent)
+                elif agent in self._again or delay <= 0:
+                    # go to the back of the line so other agents get a turn
+                    self._again.discard(agent)
+                    self._pending.add(agent)
+                    self._ready.append(agent)
+                    self._cond.notify()
+                elif delay != Agent.FOREVER:
+                    self._timers[agent] = self.scheduler.call_later(delay, self.submit, agent)
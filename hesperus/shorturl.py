@@ -1,6 +1,18 @@
-import urllib, urllib2
 import json
 import logging
+import anydbm
+import atexit
+import hashlib
+import string
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+from stats import LatencyHistogram
+from tasks import ThreadExecutor
+from httpclient import shared_client
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('hesperus.shorturl')
@@ -15,6 +27,111 @@ except Exception as err:
     google_api_key=''
 logger.debug('Using google API key: %s', google_api_key)
 
+# seconds to wait on a shortening service before giving up on it
+timeout = 10
+
+# used when short_url() and short_urls() aren't given a provider
+default_provider = "goo.gl"
+
+# how many requests short_urls() may have in flight to each provider at once
+provider_limits = {}
+default_limit = 4
+
+class ShortURLCache(object):
+    """Short URLs we already know, per provider. Lookups go to an in-memory
+    LRU of the most recently used size entries first, and then to an anydbm
+    file at path if there is one, which keeps them across restarts. Only
+    successful shortenings are stored, so a failure is retried next time.
+
+    stats() counts memory hits, disk hits and misses, along with how long
+    the services took to answer on a miss.
+
+    """
+    def __init__(self, size=1024, path='shorturl-cache.db'):
+        self.lock = threading.Lock()
+        self.size = size
+        self.path = path
+        self.entries = OrderedDict()
+        self._db = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.fetch = LatencyHistogram()
+
+    def _key(self, provider, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return provider + ' ' + url
+
+    def _open(self):
+        # callers hold the lock
+        if self._db is None and self.path:
+            try:
+                self._db = anydbm.open(self.path, 'c')
+            except Exception as err:
+                logger.warning('Could not open url cache %s: %s', self.path, err)
+                self.path = None
+        return self._db
+
+    def _remember(self, key, short):
+        # callers hold the lock
+        self.entries[key] = short
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, provider, url):
+        key = self._key(provider, url)
+        with self.lock:
+            short = self.entries.pop(key, None)
+            if short is not None:
+                self.entries[key] = short
+                self.memory_hits += 1
+                return short
+            db = self._open()
+            if db is not None and key in db:
+                short = db[key]
+                self._remember(key, short)
+                self.disk_hits += 1
+                return short
+            self.misses += 1
+            return None
+
+    def put(self, provider, url, short, seconds):
+        key = self._key(provider, url)
+        if isinstance(short, unicode):
+            short = short.encode('utf-8')
+        with self.lock:
+            self.fetch.record(seconds)
+            self._remember(key, short)
+            db = self._open()
+            if db is not None:
+                db[key] = short
+                if hasattr(db, 'sync'):
+                    db.sync()
+
+    def failed(self, seconds):
+        with self.lock:
+            self.fetch.record(seconds)
+
+    def close(self):
+        with self.lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def stats(self):
+        with self.lock:
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'cached': len(self.entries),
+                'fetch': self.fetch.summary(),
+            }
+
+cache = ShortURLCache()
+atexit.register(cache.close)
+
 providers = {}
 def provider(name):
     def inner_provider(func):
@@ -32,13 +149,12 @@ def short_url_goo_gl(url):
     apiurl = 'https://www.googleapis.com/urlshortener/v1/url?key={}'.format(google_api_key)
     data = json.dumps({'longUrl' : url})
     headers = {'Content-Type' : 'application/json'}
-    r = urllib2.Request(apiurl, data, headers)
     
     try:
-        retdata = urllib2.urlopen(r).read()
-        retdata = json.loads(retdata)
-        return retdata.get('id', url)
-    except urllib2.URLError as err:
+        r = shared_client().post(apiurl, data, headers=headers, timeout=timeout)
+        r.raise_for_status()
+        return r.json().get('id', url)
+    except requests.RequestException as err:
         logging.warning('Got error from url shortener: %s', err)
         return url
     except ValueError:
@@ -50,23 +166,195 @@ def short_url_git_io(url):
         return None
     
     apiurl = 'http://git.io'
-    data = urllib.urlencode({'url' : url})
-    r = urllib2.Request(apiurl, data)
+    data = {'url' : url}
     
     try:
-        retdata = urllib2.urlopen(r)
-        if retdata.code == 201:
-            return retdata.headers['location']
+        r = shared_client().post(apiurl, data, timeout=timeout, allow_redirects=False)
+        if r.status_code == 201:
+            return r.headers['location']
         else:
             return url
-    except urllib2.URLError:
+    except requests.RequestException:
         return url
     except ValueError:
         return url
 
-def short_url(url, provider="goo.gl"):
+CODE_ALPHABET = string.digits + string.ascii_letters
+
+class LocalShortener(object):
+    """Makes short URLs without asking anyone. A URL's code is the start of
+    its SHA-1 in base 62, so the same URL always gets the same code, and if
+    another URL already has that code it grows a character at a time until
+    it is free. Codes are kept in an anydbm file at path both ways round, so
+    shortening and looking up are a single db access each.
+
+    Something has to serve the redirects from base_url, see
+    plugins.shortener.ShortenerPlugin.
+
+    """
+    def __init__(self, base_url, path='shorturl-local.db', length=6):
+        self.base_url = base_url.rstrip('/') + '/'
+        self.length = length
+        self.lock = threading.Lock()
+        self.db = anydbm.open(path, 'c')
+
+    def _digits(self, url):
+        n = int(hashlib.sha1(url).hexdigest(), 16)
+        digits = []
+        while n:
+            n, d = divmod(n, len(CODE_ALPHABET))
+            digits.append(CODE_ALPHABET[d])
+        return ''.join(digits)
+
+    def code_for(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        with self.lock:
+            if 'u ' + url in self.db:
+                return self.db['u ' + url]
+            digits = self._digits(url)
+            for length in range(self.length, len(digits) + 1):
+                code = digits[:length]
+                if not 'c ' + code in self.db:
+                    break
+            else:
+                raise ValueError('no free short code for %s' % (url,))
+            self.db['c ' + code] = url
+            self.db['u ' + url] = code
+            if hasattr(self.db, 'sync'):
+                self.db.sync()
+            return code
+
+    def shorten(self, url):
+        return self.base_url + self.code_for(url)
+
+    def lookup(self, code):
+        """The URL with this code, or None"""
+        with self.lock:
+            if 'c ' + code in self.db:
+                return self.db['c ' + code]
+            return None
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# set while a ShortenerPlugin is running
+local_shortener = None
+# providers that answer from a store of their own, so they are called
+# directly rather than through the cache or short_urls()' threads
+local_providers = set(["local"])
+
+@provider("local")
+def short_url_local(url):
+    if not url or local_shortener is None:
+        return url
+    return local_shortener.shorten(url)
+
+def short_url(url, provider=None):
     global providers
-    try:
-        return providers[provider](url)
-    except KeyError:
+    if provider is None:
+        provider = default_provider
+    if not url or not provider in providers:
         return url
+    if provider in local_providers:
+        return providers[provider](url)
+    short = cache.get(provider, url)
+    if short is not None:
+        return short
+    return _fetch(url, provider)
+
+def _fetch(url, provider):
+    """Asks the provider, and caches the result if it worked"""
+    start = time.time()
+    short = providers[provider](url)
+    if short and short != url:
+        cache.put(provider, url, short, time.time() - start)
+    else:
+        cache.failed(time.time() - start)
+    return short
+
+class _BatchResult(object):
+    """Stands in for a tasks.Future, so ThreadExecutor can hand back results
+    to a thread waiting in short_urls()"""
+    def __init__(self, cond):
+        self.cond = cond
+        self.done = False
+        self.result = None
+
+    def set_result(self, result):
+        with self.cond:
+            self.done = True
+            self.result = result
+            self.cond.notify_all()
+
+    def set_exception(self, exc_info):
+        logger.warning('Error from url shortener: %s', exc_info[1])
+        self.set_result(None)
+
+# provider -> ThreadExecutor, each with provider_limits threads
+_executors = {}
+_executors_lock = threading.Lock()
+
+def _executor(provider):
+    with _executors_lock:
+        if not provider in _executors:
+            _executors[provider] = ThreadExecutor(provider_limits.get(provider, default_limit))
+        return _executors[provider]
+
+def short_urls(urls, provider=None, wait=None):
+    """Shortens many URLs at once, and returns the results in the same order.
+
+    Cached URLs are answered right away and the rest are shortened
+    concurrently, at most provider_limits[provider] at a time. Items of urls
+    may also be (url, provider) pairs to mix providers in one batch, where a
+    provider of None means the batch's provider. After wait seconds, timeout
+    by default, any URL still not shortened comes back as it was. Its
+    request carries on, so it will be cached next time.
+
+    """
+    if provider is None:
+        provider = default_provider
+    urls = list(urls)
+    cond = threading.Condition()
+    results = []
+    pending = {}
+    for item in urls:
+        if isinstance(item, tuple):
+            url, item_provider = item
+        else:
+            url, item_provider = item, None
+        if item_provider is None:
+            item_provider = provider
+        key = (url, item_provider)
+        if key in pending:
+            results.append(pending[key])
+            continue
+        if not url or not item_provider in providers or item_provider in local_providers:
+            results.append(short_url(url, item_provider))
+            continue
+        short = cache.get(item_provider, url)
+        if short is not None:
+            results.append(short)
+            continue
+        result = _BatchResult(cond)
+        _executor(item_provider).submit(result, _fetch, (url, item_provider), {})
+        pending[key] = result
+        results.append(result)
+
+    deadline = time.time() + (timeout if wait is None else wait)
+    with cond:
+        while not all(result.done for result in pending.values()):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            cond.wait(remaining)
+
+    shortened = []
+    for item, result in zip(urls, results):
+        if isinstance(result, _BatchResult):
+            url = item[0] if isinstance(item, tuple) else item
+            with cond:
+                result = result.result if result.done and result.result else url
+        shortened.append(result)
+    return shortened
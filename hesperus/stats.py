@@ -0,0 +1,115 @@
+"""Counters and latency histograms for agents.
+
+Every Agent keeps an AgentStats in self.stats. The core collects them with
+Core.collect_stats(), and the StatsPlugin reports them in chat.
+
+"""
+import threading
+import bisect
+
+# bucket upper bounds in seconds, doubling from 10us to about 3 minutes
+BUCKETS = tuple(0.00001 * 2 ** i for i in range(25))
+
+class LatencyHistogram(object):
+    """Counts durations in exponentially sized buckets, so recording costs
+    the same no matter how many samples there are and percentiles come out
+    within a factor of two.
+
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        # callers hold the owning AgentStats' lock
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """The upper bound of the bucket holding the p-th percentile"""
+        if not self.count:
+            return 0.0
+        wanted = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= wanted and n:
+                if i < len(BUCKETS):
+                    return min(BUCKETS[i], self.max)
+                return self.max
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+class AgentStats(object):
+    """What an agent spends its time on.
+
+    enqueue_delay   time from a queued call being made to it starting to run
+    handler         time spent running queued calls
+    step            time spent in each run() step
+    blocked_put     time callers spent waiting for room in a full queue
+
+    and counts of queued calls that were dropped or coalesced, see
+    agent.AgentQueue.
+
+    Agents can record and count anything else under names of their own,
+    which show up in the summary alongside these.
+
+    """
+    histograms = ('enqueue_delay', 'handler', 'step', 'blocked_put')
+    counters = ('dropped', 'coalesced')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        for name in self.histograms:
+            setattr(self, name, LatencyHistogram())
+        for name in self.counters:
+            setattr(self, name, 0)
+        self.queue_high_water = 0
+        # name -> LatencyHistogram or count, for an agent's own stats
+        self.extra = {}
+
+    def record(self, name, seconds):
+        with self.lock:
+            if name in self.histograms:
+                histogram = getattr(self, name)
+            else:
+                histogram = self.extra.setdefault(name, LatencyHistogram())
+            histogram.record(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            if name in self.counters:
+                setattr(self, name, getattr(self, name) + n)
+            else:
+                self.extra[name] = self.extra.get(name, 0) + n
+
+    def queue_depth(self, depth):
+        # only ever compared and raised, so a stale read is harmless
+        if depth > self.queue_high_water:
+            with self.lock:
+                self.queue_high_water = max(self.queue_high_water, depth)
+
+    def summary(self):
+        with self.lock:
+            result = dict((name, getattr(self, name).summary()) for name in self.histograms)
+            for name in self.counters:
+                result[name] = getattr(self, name)
+            result['queue_high_water'] = self.queue_high_water
+            for name, value in self.extra.items():
+                if isinstance(value, LatencyHistogram):
+                    value = value.summary()
+                result[name] = value
+        return result
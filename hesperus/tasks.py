@@ -0,0 +1,251 @@
+"""Generator based coroutines hosted on a single event loop thread.
+
+This is the same idea as asyncio, built from plain generators since that is
+what the rest of hesperus already uses. A coroutine is a generator that
+yields the things it is waiting for:
+
+    a Future            resumes with the future's result, or raises its error
+    a generator         runs it as a sub-coroutine and resumes with its result
+    a list or tuple     of the above, waits for all of them, resumes with a
+                        list of their results
+    a number            sleeps that many seconds
+    None                lets other coroutines run and resumes right after
+
+To return a value from a coroutine, raise Return(value).
+
+Blocking calls such as urllib2.urlopen() must not run on the loop itself.
+Hand them to EventLoop.run_in_executor() and yield the future it returns.
+
+"""
+import sys
+import threading
+from types import GeneratorType
+from Queue import Queue
+
+from runtime import Scheduler
+
+class Return(Exception):
+    """Raise this from a coroutine to return a value"""
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+class CancelledError(Exception):
+    pass
+
+class Future(object):
+    """The result of an operation that may not have finished yet. Callbacks
+    always run on the loop thread, no matter which thread sets the result.
+
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self._lock = threading.Lock()
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise RuntimeError('result is not ready yet')
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exc_info(self):
+        return self._exc_info
+
+    def add_done_callback(self, func):
+        with self._lock:
+            if not self._done:
+                self._callbacks.append(func)
+                return
+        self.loop.call_soon(func, self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exc_info):
+        """Takes a sys.exc_info() tuple so the traceback survives"""
+        self._finish(None, exc_info)
+
+    def _finish(self, result, exc_info):
+        with self._lock:
+            if self._done:
+                return
+            self._done = True
+            self._result = result
+            self._exc_info = exc_info
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            self.loop.call_soon(func, self)
+
+class Task(Future):
+    """Drives a coroutine on the loop. The task is itself a future for the
+    coroutine's return value.
+
+    idle_delay is how long a bare yield sleeps. Coroutines use 0, but the
+    loop also hosts old style Agent.run() generators, whose bare yields have
+    always meant "poll again in a little while".
+
+    """
+    def __init__(self, loop, coro, idle_delay=0):
+        super(Task, self).__init__(loop)
+        self.coro = coro
+        self.idle_delay = idle_delay
+        self._timer = None
+
+    def cancel(self):
+        if self.done():
+            return
+        if self._timer is not None:
+            self.loop.cancel(self._timer)
+        try:
+            self.coro.close()
+        except Exception:
+            pass
+        try:
+            raise CancelledError()
+        except CancelledError:
+            self.set_exception(sys.exc_info())
+
+    def _step(self, value=None, exc_info=None):
+        self._timer = None
+        if self.done():
+            return
+        try:
+            if exc_info is not None:
+                yielded = self.coro.throw(*exc_info)
+            else:
+                yielded = self.coro.send(value)
+        except Return, r:
+            self.set_result(r.value)
+            return
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Exception:
+            self.set_exception(sys.exc_info())
+            return
+        self._wait_for(yielded)
+
+    def _wait_for(self, yielded):
+        if yielded is None:
+            yielded = self.idle_delay
+        if isinstance(yielded, (int, long, float)):
+            if yielded != float('inf'):
+                self._timer = self.loop.call_later(yielded, self._step)
+            return
+
+        try:
+            future = self.loop.future_for(yielded)
+        except TypeError:
+            self.loop.call_soon(self._step, None, sys.exc_info())
+        else:
+            future.add_done_callback(self._wakeup)
+
+    def _wakeup(self, future):
+        try:
+            value = future.result()
+        except Exception:
+            self._step(exc_info=sys.exc_info())
+        else:
+            self._step(value)
+
+class ThreadExecutor(object):
+    """A bounded set of threads for running blocking calls off the loop"""
+    def __init__(self, size):
+        self.size = size
+        self._jobs = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, future, func, args, kwargs):
+        with self._lock:
+            # threads are only started once something needs them
+            if not self._threads:
+                for i in range(self.size):
+                    thread = threading.Thread(target=self._work,
+                            name='hesperus-executor-%d' % (i,))
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+        self._jobs.put((future, func, args, kwargs))
+
+    def _work(self):
+        while True:
+            future, func, args, kwargs = self._jobs.get()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+
+class EventLoop(Scheduler):
+    """The thread that runs all coroutines. Callbacks are just timers that
+    are already due, so the loop sleeps in select() whenever there is nothing
+    to do.
+
+    """
+    def __init__(self, executor_size=16):
+        super(EventLoop, self).__init__(name='hesperus-loop')
+        self.executor = ThreadExecutor(executor_size)
+
+    def call_soon(self, func, *args):
+        # every due timer has a time in the past, 0 sorts before all of them
+        # but still keeps call_soon() callbacks in FIFO order
+        return self.call_at(0, func, *args)
+
+    def spawn(self, coro, idle_delay=0):
+        """Starts running a coroutine and returns its Task"""
+        task = Task(self, coro, idle_delay)
+        self.call_soon(task._step)
+        return task
+
+    def run_in_executor(self, func, *args, **kwargs):
+        """Runs a blocking call on the executor's threads, and returns a future
+        for its result
+
+        """
+        future = Future(self)
+        self.executor.submit(future, func, args, kwargs)
+        return future
+
+    def gather(self, awaitables):
+        """Returns a future for the list of results of all the awaitables. If
+        any of them fails, the future fails with the first error.
+
+        """
+        futures = [self.future_for(a) for a in awaitables]
+        gathered = Future(self)
+        if not futures:
+            gathered.set_result([])
+            return gathered
+        remaining = [len(futures)]
+        def done(_):
+            remaining[0] -= 1
+            if remaining[0] > 0 or gathered.done():
+                return
+            for f in futures:
+                if f.exc_info() is not None:
+                    gathered.set_exception(f.exc_info())
+                    return
+            gathered.set_result([f.result() for f in futures])
+        for f in futures:
+            f.add_done_callback(done)
+        return gathered
+
+    def future_for(self, awaitable):
+        """Turns anything a coroutine may yield for into a Future"""
+        if isinstance(awaitable, Future):
+            return awaitable
+        if isinstance(awaitable, GeneratorType):
+            return self.spawn(awaitable)
+        if isinstance(awaitable, (list, tuple)):
+            return self.gather(awaitable)
+        raise TypeError('coroutines cannot yield %r' % (awaitable,))
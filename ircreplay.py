@@ -0,0 +1,188 @@
+"""Plays traffic captured by the IRC plugin back to a running bot.
+
+    python ircreplay.py capture.log [--server NAME] [--port 6667]
+                                    [--speed 1] [--output sent.log]
+                                    [--linger 5]
+
+This stands in for the IRC server. It listens on localhost, waits for the
+bot to connect and register, and then sends it the lines from a capture made
+with the IRC plugin's capture_file setting, spaced out the way they arrived
+but --speed times faster. --speed 0 sends them as fast as the bot will read
+them. A capture holds every server the plugin was connected to; --server
+picks one by name, and the first one in the file is used otherwise.
+
+Point the bot at localhost:PORT with the nick it had when the capture was
+made, since the captured lines still name that nick. The capture also
+starts with the server's welcome, so there is nothing else to set up.
+
+Everything the bot sends back is written to --output as
+
+    <seconds since the replay started> <raw line>
+
+Strip the times, with cut -d' ' -f2- say, to diff what two versions of the
+bot said about the same traffic. After the last line we keep listening for
+--linger seconds so rate limited replies can finish, then report how long
+the replay took, how far it fell behind schedule because the bot couldn't
+keep up, and how much the bot sent back.
+
+"""
+import argparse
+import socket
+import sys
+import threading
+import time
+
+def read_capture(path, server=None):
+    """Returns the name of the server and its (time, line) pairs"""
+    lines = []
+    with open(path) as f:
+        for entry in f:
+            entry = entry.rstrip('\r\n')
+            if not entry:
+                continue
+            stamp, name, line = entry.split(' ', 2)
+            if server is None:
+                server = name
+            if name == server:
+                lines.append((float(stamp), line))
+    return server, lines
+
+class Recorder(threading.Thread):
+    """Reads what the bot sends us and writes it to output"""
+    def __init__(self, conn, output, started):
+        super(Recorder, self).__init__(name='ircreplay-recorder')
+        self.daemon = True
+        self.conn = conn
+        self.output = output
+        self.started = started
+        self.registered = threading.Event()
+        self.lock = threading.Lock()
+        self.lines = 0
+        self.privmsgs = 0
+        self.last_line = None
+
+    def run(self):
+        buf = ''
+        while True:
+            try:
+                data = self.conn.recv(4096)
+            except socket.error:
+                break
+            if not data:
+                break
+            buf += data
+            lines = buf.split('\n')
+            buf = lines.pop()
+            for line in lines:
+                self.record(line.rstrip('\r'))
+        # nothing more will come, don't leave anyone waiting
+        self.registered.set()
+
+    def record(self, line):
+        command = line.split(' ', 1)[0].upper()
+        if command == 'USER':
+            self.registered.set()
+        now = time.time()
+        with self.lock:
+            if self.started is not None:
+                offset = now - self.started
+            else:
+                offset = 0.0
+            self.output.write("%.3f %s\n" % (offset, line))
+            self.lines += 1
+            if command == 'PRIVMSG':
+                self.privmsgs += 1
+            self.last_line = now
+
+    def start_replay(self):
+        with self.lock:
+            self.started = time.time()
+            return self.started
+
+def replay(conn, lines, speed):
+    """Sends the captured lines on schedule and returns how far behind it fell
+    at worst, in seconds"""
+    start = time.time()
+    first = lines[0][0] if lines else 0.0
+    behind = 0.0
+    for stamp, line in lines:
+        if speed:
+            due = start + (stamp - first) / speed
+            now = time.time()
+            if due > now:
+                time.sleep(due - now)
+            else:
+                behind = max(behind, now - due)
+        conn.sendall(line + '\r\n')
+    return behind
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Replay captured IRC traffic to a bot')
+    parser.add_argument('capture')
+    parser.add_argument('--server', default=None,
+            help='which server in the capture to replay, default is the first')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6667)
+    parser.add_argument('--speed', type=float, default=1.0,
+            help='how many times faster than captured, 0 for as fast as possible')
+    parser.add_argument('--output', default='-',
+            help='where to write what the bot sent, default is stdout')
+    parser.add_argument('--linger', type=float, default=5.0,
+            help='seconds to wait for replies after the last line')
+    args = parser.parse_args(argv)
+
+    server, lines = read_capture(args.capture, args.server)
+    if not lines:
+        print >>sys.stderr, "nothing to replay in %s" % (args.capture,)
+        return 1
+    span = lines[-1][0] - lines[0][0]
+    print >>sys.stderr, "%d lines from %s over %.1fs" % (len(lines), server, span)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((args.host, args.port))
+    listener.listen(1)
+    print >>sys.stderr, "waiting for the bot on %s:%d..." % (args.host, args.port)
+    conn, addr = listener.accept()
+    listener.close()
+
+    if args.output == '-':
+        output = sys.stdout
+    else:
+        output = open(args.output, 'w')
+    recorder = Recorder(conn, output, None)
+    recorder.start()
+    recorder.registered.wait()
+
+    started = recorder.start_replay()
+    try:
+        behind = replay(conn, lines, args.speed)
+    except socket.error, e:
+        print >>sys.stderr, "the bot went away: %s" % (e,)
+        behind = None
+    elapsed = time.time() - started
+
+    # wait until the bot has been quiet for the linger time
+    while recorder.is_alive():
+        with recorder.lock:
+            last = recorder.last_line or started
+        remaining = max(last, started + elapsed) + args.linger - time.time()
+        if remaining <= 0:
+            break
+        time.sleep(min(remaining, 0.1))
+    conn.close()
+    recorder.join(1.0)
+    with recorder.lock:
+        if output is not sys.stdout:
+            output.close()
+        received, privmsgs = recorder.lines, recorder.privmsgs
+
+    print >>sys.stderr, "replayed %d lines in %.2fs, %.0f lines/s" % (
+            len(lines), elapsed, len(lines) / max(elapsed, 1e-6))
+    if behind is not None and args.speed:
+        print >>sys.stderr, "fell behind schedule by up to %.3fs" % (behind,)
+    print >>sys.stderr, "the bot sent %d lines, %d of them PRIVMSG" % (received, privmsgs)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,58 @@
+import unittest
+
+try:
+    from hesperus.plugins.hesperus_irc import OutboundQueue, INTERACTIVE, BROADCAST
+except ImportError:
+    OutboundQueue = None
+
+@unittest.skipIf(OutboundQueue is None, 'the irc package is not installed')
+class OutboundQueueTest(unittest.TestCase):
+    def test_coalesced_lines_leave_the_queue(self):
+        q = OutboundQueue(5, 2.0, coalesce_window=0.1)
+        for i in range(4):
+            q.push('#chan', 'line %d' % (i,), INTERACTIVE)
+        self.assertEqual(len(q), 4)
+        lines, delay = q.take_sendable(q.message_bucket.last + 1)
+        self.assertEqual(lines, [('#chan', 'line 0 | line 1 | line 2 | line 3', INTERACTIVE)])
+        self.assertEqual(delay, None)
+        self.assertEqual(len(q), 0)
+
+    def test_joined_line_waiting_on_the_limit_counts_once(self):
+        q = OutboundQueue(1, 60.0, coalesce_window=0.1)
+        q.push('#chan', 'first', INTERACTIVE)
+        now = q.message_bucket.last + 1
+        self.assertEqual(len(q.take_sendable(now)[0]), 1)
+        for i in range(3):
+            q.push('#chan', 'line %d' % (i,), INTERACTIVE)
+        lines, delay = q.take_sendable(now + 1)
+        self.assertEqual(lines, [])
+        self.assertTrue(delay > 0)
+        self.assertEqual(len(q), 1)
+
+    def test_trim_after_coalescing(self):
+        q = OutboundQueue(1, 60.0, coalesce_window=0.1, max_lines=2)
+        q.push('#chan', 'first', INTERACTIVE)
+        now = q.message_bucket.last + 1
+        q.take_sendable(now)
+        q.push('#chan', 'a', INTERACTIVE)
+        q.push('#chan', 'b', INTERACTIVE)
+        q.take_sendable(now + 1)
+        self.assertEqual(len(q), 1)
+        # the joined line and one more fit, nothing is dropped
+        q.push('#other', 'c', BROADCAST)
+        self.assertEqual(len(q), 2)
+
+    def test_hand_over_forwards_waiting_and_later_lines(self):
+        q = OutboundQueue(5, 2.0)
+        successor = OutboundQueue(5, 2.0)
+        q.push('#chan', 'waiting', INTERACTIVE)
+        q.hand_over(successor.push)
+        q.push('#chan', 'later', BROADCAST)
+        q.requeue([('#chan', 'unsent', INTERACTIVE)])
+        self.assertEqual(len(q), 0)
+        lines, delay = successor.take_sendable(successor.message_bucket.last + 1)
+        self.assertEqual(sorted(text for target, text, priority in lines),
+                ['later', 'unsent', 'waiting'])
+
+if __name__ == '__main__':
+    unittest.main()